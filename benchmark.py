@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#Benchmark for drive_info.py, replays synthetic command output for hosts with different numbers of drives
+#so the cost of each stage can be measured (and compared between versions) without real HP hardware
+
+import os, json
+import time
+import shutil
+import tempfile
+import logging
+
+import drive_info
+
+#simulated latency (seconds) of each command, roughly what a Gen8 HP server takes
+LATENCIES = {'lsblk'      : 0.02,
+             'lshw'       : 1.5,
+             'ssacli'     : 2.0,
+             'smartctl -i': 0.1,
+             'smartctl -a': 0.3,
+             'cciss'      : 1.2,    #smartctl behind a Smart Array controller
+             'nvme-ioctl' : 0.001,  #NVMe admin get log page
+             'virt-what'  : 0.05}
+
+DRIVES_PER_ARRAY = 8
+DRIVES_PER_CONTROLLER = 100
+
+SSD_TEXT = '''smartctl 7.0 2018-12-30 r4883 [x86_64-linux-5.4.157-1-pve] (local build)
+
+=== START OF INFORMATION SECTION ===
+Device Model:     Samsung SSD 850 EVO 500GB
+Serial Number:    S21JNXAG%06d
+Rotation Rate:    Solid State Device
+SMART support is: Available - device has SMART capability.
+SMART support is: Enabled
+
+=== START OF READ SMART DATA SECTION ===
+SMART overall-health self-assessment test result: PASSED
+
+ID# ATTRIBUTE_NAME          FLAG     VALUE WORST THRESH TYPE      UPDATED  WHEN_FAILED RAW_VALUE
+  5 Reallocated_Sector_Ct   0x0033   100   100   010    Pre-fail  Always       -       0
+  9 Power_On_Hours          0x0032   096   096   000    Old_age   Always       -       15544
+177 Wear_Leveling_Count     0x0013   099   099   000    Pre-fail  Always       -       12
+190 Airflow_Temperature_Cel 0x0032   056   047   000    Old_age   Always       -       44
+241 Total_LBAs_Written      0x0032   099   099   000    Old_age   Always       -       1475084530
+'''
+
+NVME_TEXT = '''smartctl 7.0 2018-12-30 r4883 [x86_64-linux-5.4.157-1-pve] (local build)
+
+=== START OF INFORMATION SECTION ===
+Model Number:                       Samsung SSD 970 EVO Plus 1TB
+Serial Number:                      S4EWNX0M%06d
+
+=== START OF SMART DATA SECTION ===
+SMART overall-health self-assessment test result: PASSED
+
+SMART/Health Information (NVMe Log 0x02)
+Temperature:                        38 Celsius
+Available Spare:                    88%%
+Percentage Used:                    3%%
+Data Units Written:                 18,867,188 [9.66 TB]
+Power On Hours:                     6,315
+'''
+
+SAS_TEXT = '''smartctl 7.0 2018-12-30 r4883 [x86_64-linux-5.4.157-1-pve] (local build)
+
+=== START OF INFORMATION SECTION ===
+Vendor:               HP
+Product:              EG0600FBDSR
+Serial number:        6SL1ABCD%012d
+Device type:          disk
+SMART support is:     Available - device has SMART capability.
+SMART support is:     Enabled
+
+=== START OF READ SMART DATA SECTION ===
+SMART Health Status: OK
+
+Current Drive Temperature:     38 C
+
+Error counter log:
+           Errors Corrected by           Total   Correction     Gigabytes    Total
+               ECC          rereads/    errors   algorithm      processed    uncorrected
+           fast | delayed   rewrites  corrected  invocations   [10^9 bytes]  errors
+read:   1802155        0         0   1802155          0     164413.902           0
+write:         0        0         0         0          0      47285.315           0
+
+SMART Self-test log
+Num  Test              Status                 segment  LifeTime  LBA_first_err [SK ASC ASQ]
+     Description                              number   (hours)
+# 1  Background short  Completed                   -   27358                 - [-   -    -]
+'''
+
+def nvme_smart_log(temp=38, spare=88, used=3, units_written=18867188, power_on_hours=6315):
+    '''
+    returns an NVMe SMART / Health Information log page with the same values as NVME_TEXT
+    '''
+    page = bytearray(512)
+    page[1:3] = (temp + 273).to_bytes(2, 'little')
+    page[3] = spare
+    page[5] = used
+    page[48:64] = units_written.to_bytes(16, 'little')
+    page[128:144] = power_on_hours.to_bytes(16, 'little')
+    return bytes(page)
+    
+def disk_name(index):
+    '''
+    returns the name of the index'th sd disk, eg 0: sda, 25: sdz, 26: sdaa
+    '''
+    letters = ''
+    index += 1
+    while index > 0:
+        index, letter = divmod(index - 1, 26)
+        letters = chr(ord('a') + letter) + letters
+    return 'sd' + letters
+
+def write_file(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text + '\n')
+        
+def synthetic_sysfs(sysfs, lshw, blockdevices):
+    '''
+    write a sysfs tree in sysfs with the same drives and controllers as the lshw and lsblk output, for drive_info.sysfs_drives
+    '''
+    classes = {'SATA controller': '0x010601', 'RAID bus controller': '0x010400', 'Non-Volatile memory controller': '0x010802'}
+    sizes = {device['name']: int(float(device['size'][:-1]) * 2**30 // 512) for device in blockdevices}
+    for bus, controller in enumerate(lshw):
+        pci = os.path.join(sysfs, 'devices', 'pci0000:00', '0000:%02x:00.0' % (bus + 1))
+        write_file(os.path.join(pci, 'class'), classes[controller['description']])
+        for target, drive in enumerate(controller.get('children', [])):
+            name = os.path.basename(drive['logicalname'])
+            device = os.path.join(pci, 'host%d' % bus, 'target%d:0:%d' % (bus, target), '%d:0:%d:0' % (bus, target))
+            write_file(os.path.join(device, 'vendor'), 'ATA' if drive['description'] == 'ATA Disk' else 'HP')
+            write_file(os.path.join(device, 'model'), drive['product'])
+            write_file(os.path.join(device, 'type'), '0')
+            write_file(os.path.join(sysfs, 'block', name, 'size'), str(sizes[name]))
+            write_file(os.path.join(sysfs, 'block', name, 'queue', 'rotational'), '0' if 'SSD' in drive['product'] else '1')
+            os.symlink(device, os.path.join(sysfs, 'block', name, 'device'))
+    for device in blockdevices:
+        write_file(os.path.join(sysfs, 'block', device['name'], 'size'), str(sizes[device['name']]))
+        
+def synthetic_host(directory, num_drives):
+    '''
+    save the command output for a host with num_drives physical drives in directory, for drive_info.replay_runner
+    a SATA SSD and an NVME drive, and the rest in arrays of up to DRIVES_PER_ARRAY drives behind Smart Array controllers,
+    the first array is a RAID 1 pair (with it's members listed again in mirror groups, as ssacli does), the others are RAID 5
+    the same drives are in a sysfs tree in directory/sys
+    virt-what prints nothing, it's bare metal
+    '''
+    def save(cmd_string, output, latency, returncode=0):
+        drive_info.save_fixture(directory, cmd_string.split(), output.encode('utf8'), returncode, latency)
+
+    plain = min(num_drives, 2)
+    raid_drives = num_drives - plain
+    blockdevices = [{'name': 'sda', 'size': '465.8G', 'type': 'disk', 'mountpoint': None,
+                     'children': [{'name': 'sda1', 'size': '465.8G', 'type': 'part', 'mountpoint': '/'}]}]
+    lshw = [{'description': 'SATA controller', 'product': 'C600/X79 series chipset 6-Port SATA AHCI Controller', 'physid': '1f.2',
+             'children': [{'description': 'ATA Disk', 'product': 'Samsung SSD 850', 'logicalname': '/dev/sda', 'size': 500107862016}]}]
+    save('smartctl -i /dev/sda', SSD_TEXT % 0, LATENCIES['smartctl -i'])
+    save('smartctl -a /dev/sda', SSD_TEXT % 0, LATENCIES['smartctl -a'])
+    if plain > 1:
+        blockdevices.append({'name': 'nvme0n1', 'size': '931.5G', 'type': 'disk', 'mountpoint': None})
+        lshw.append({'description': 'Non-Volatile memory controller', 'product': 'NVMe SSD Controller SM981/PM981/PM983', 'physid': '0'})
+        save('smartctl -i /dev/nvme0n1', NVME_TEXT % 1, LATENCIES['smartctl -i'])
+        save('smartctl -a /dev/nvme0n1', NVME_TEXT % 1, LATENCIES['smartctl -a'])
+        drive_info.save_fixture(directory, ['nvme-ioctl', 'get-log-page', '0x02', '/dev/nvme0n1'], nvme_smart_log(), 0, LATENCIES['nvme-ioctl'])
+
+    config = ''
+    disk_no = 1
+    for slot, first in enumerate(range(0, raid_drives, DRIVES_PER_CONTROLLER)):
+        controller = {'description': 'RAID bus controller', 'product': 'Smart Array Gen8 Controllers', 'physid': str(slot), 'children': []}
+        lshw.append(controller)
+        config += 'Smart Array P420i in Slot %d\n   Slot: %d\n   Controller Status: OK\n\n' % (slot, slot)
+        bays = list(range(1, min(DRIVES_PER_CONTROLLER, raid_drives - first) + 1))
+        arrays = [bays[array_first:array_first + DRIVES_PER_ARRAY] for array_first in range(2, len(bays), DRIVES_PER_ARRAY)]
+        if slot == 0:
+            arrays.insert(0, bays[:2])
+        else:
+            arrays = [bays[array_first:array_first + DRIVES_PER_ARRAY] for array_first in range(0, len(bays), DRIVES_PER_ARRAY)]
+        for array_no, array_bays in enumerate(arrays):
+            mirror = slot == 0 and array_no == 0 and len(array_bays) == 2
+            data_drives = 1 if mirror else len(array_bays) - 1
+            name = disk_name(disk_no)
+            disk_no += 1
+            blockdevices.append({'name': name, 'size': '%dG' % (600 * data_drives), 'type': 'disk', 'mountpoint': None})
+            controller['children'].append({'description': 'SCSI Disk', 'product': 'LOGICAL VOLUME', 'logicalname': '/dev/' + name,
+                                           'size': 600127266816 * data_drives})
+            config += '   Array: %s\n      Interface Type: SAS\n      Status: OK\n\n' % disk_name(array_no)[2:].upper()
+            config += '      Logical Drive: 1\n         Size: %d GB\n         Fault Tolerance: %s\n         Status: OK\n         Disk Name: /dev/%s\n' % (
+                       600 * data_drives, 1 if mirror else 5, name)
+            if mirror:
+                for group, bay in enumerate(array_bays):
+                    config += '         Mirror Group %d:\n            physicaldrive 1I:1:%d (port 1I:box 1:bay %d, SAS HDD, 600 GB, OK)\n' % (group + 1, bay, bay)
+            config += '         Drive Type: Data\n         LD Acceleration Method: Controller Cache\n\n'
+            save('smartctl -i /dev/%s' % name, 'Device type:          disk\nSMART support is:     Enabled\n', LATENCIES['smartctl -i'])
+            for bay in array_bays:
+                serial = slot * 1000 + bay
+                config += '      physicaldrive 1I:1:%d\n         Port: 1I\n         Box: 1\n         Bay: %d\n         Status: OK\n' % (bay, bay)
+                config += '         Interface Type: SAS\n         Size: 600 GB\n         Serial Number: 6SL1ABCD%012d\n         Model: HP      EG0600FBDSR\n\n' % serial
+                save('smartctl -a /dev/%s -d cciss,%d' % (name, bay - 1), SAS_TEXT % serial, LATENCIES['cciss'])
+
+    save('lsblk -J', json.dumps({'blockdevices': blockdevices}, indent=3), LATENCIES['lsblk'])
+    save('lshw -C storage -C disk -json', '\n'.join(json.dumps(controller, indent=2) for controller in lshw), LATENCIES['lshw'])
+    save('ssacli ctrl all show config detail', config, LATENCIES['ssacli'] + 0.01 * raid_drives)
+    save('/usr/sbin/virt-what', '', LATENCIES['virt-what'])  #bare metal
+    synthetic_sysfs(os.path.join(directory, 'sys'), lshw, blockdevices)
+
+class arguments():
+    summary = True
+
+def run_stage(runner, func, *args):
+    '''
+    returns the result of func(*args), and a dict of the wall time, CPU time (the parsing and other python work)
+    and number of commands run
+    '''
+    calls = len(runner.calls)
+    start = time.time()
+    cpu_start = time.process_time()
+    result = func(*args)
+    return result, {'wall'     : time.time() - start,
+                    'cpu'      : time.process_time() - cpu_start,
+                    'commands' : len(runner.calls) - calls}
+
+def benchmark(num_drives, latency=0, workers=1, controller_workers=2, discovery='sysfs'):
+    '''
+    returns a dict of stage: timings, for a synthetic host with num_drives
+    discovery is how get_drives finds the drives, 'sysfs' or 'lshw' (lsblk and lshw)
+    '''
+    directory = tempfile.mkdtemp(prefix='drive_info_benchmark_')
+    cwd = os.getcwd()
+    try:
+        synthetic_host(os.path.join(directory, 'fixtures'), num_drives)
+        drive_info.SYSFS = os.path.join(directory, 'fixtures', 'sys')
+        drive_info.discovery = discovery
+        os.chdir(directory)     #so there is no drivedb.h
+        drive_info.drivedb = drive_info.drive_database(os.path.join(directory, 'cache'), max_age=0)
+        runner = drive_info.runner = drive_info.replay_runner(os.path.join(directory, 'fixtures'), latency, max_running=max(8, workers))
+        drive_info.raid_data = None
+        drive_info.PROC_MDSTAT = os.path.join(directory, 'fixtures', 'mdstat')  #no md arrays
+        stages = {}
+        drives, stages['get_drives'] = run_stage(runner, drive_info.get_drives, os.path.join(directory, 'config.ini'))
+        drive_data, stages['get_smart_data'] = run_stage(runner, drive_info.get_smart_data, drives, workers, controller_workers, False, False)
+        summary, stages['get_smart_data_summary'] = run_stage(runner, drive_info.get_smart_data_summary, drive_data)
+        raid_issues, stages['check_raid_failures'] = run_stage(runner, drive_info.check_raid_failures, arguments())
+        runner.stop()
+        stages['total'] = {name: sum(stage[name] for stage in stages.values()) for name in ['wall', 'cpu', 'commands']}
+        if sum(len(drive.records) for drive in drive_data.values()) != num_drives:
+            raise RuntimeError('expected %d drives, found %d' % (num_drives, sum(len(drive.records) for drive in drive_data.values())))
+        return stages
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark drive_info.py stages on synthetic hosts, using replayed command output')
+    parser.add_argument('-n','--drives', action='store',type=int, nargs='+', default=[4, 24, 200], help='number of physical drives in each synthetic host (default: 4 24 200)')
+    parser.add_argument('-l','--latency', action='store',type=float, default=0, help='multiply the simulated command latencies by this (default: 0, no latency)')
+    parser.add_argument('-w','--workers', action='store',type=int, default=1, help='number of drives to query in parallel (default: 1)')
+    parser.add_argument('-cw','--controllerworkers', action='store',type=int, default=2, help='max number of drives to query in parallel on one RAID controller (default: 2)')
+    parser.add_argument('-di','--discovery', action='store',type=str, choices=['sysfs', 'lshw'], default='sysfs', help='find the drives from sysfs, or with lsblk and lshw (default: sysfs)')
+    parser.add_argument('-r','--repeat', action='store',type=int, default=3, help='runs for each host, the fastest is reported (default: 3)')
+    parser.add_argument('-j','--json', action='store_true', help='print the results as JSON', default = False)
+    arg = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    drive_info.log = logging.getLogger('drive_info')
+
+    results = {}
+    for num_drives in arg.drives:
+        runs = [benchmark(num_drives, arg.latency, arg.workers, arg.controllerworkers, arg.discovery) for run in range(max(arg.repeat, 1))]
+        results[num_drives] = min(runs, key=lambda stages: stages['total']['wall'])
+
+    if arg.json:
+        print(json.dumps(results, indent=2))
+        return
+    print('%6s  %-24s %10s %10s %9s' % ('drives', 'stage', 'wall (s)', 'cpu (s)', 'commands'))
+    for num_drives, stages in results.items():
+        for stage, timing in stages.items():
+            print('%6d  %-24s %10.4f %10.4f %9d' % (num_drives, stage, timing['wall'], timing['cpu'], timing['commands']))
+
+if __name__ == "__main__":
+    main()
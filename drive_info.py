@@ -15,197 +15,1249 @@ import datetime as dt
 import logging
 from logging.handlers import RotatingFileHandler
 import threading
+import queue
 import subprocess
-from subprocess import check_output, CalledProcessError
+from subprocess import CalledProcessError, TimeoutExpired
+import asyncio
+import signal
+import socket
+import socketserver
+import hashlib
+import cProfile
+import pstats
+import io
+import errno
+import struct
+import ctypes
+import fcntl
+from contextlib import contextmanager
+import sqlite3
+import http.client
+import urllib.request
+import urllib.error
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+from itertools import zip_longest
 
 global log
 
+#default timeout (seconds) for each external tool, a hung command is killed after this
+COMMAND_TIMEOUTS = {'smartctl' : 60,
+                    'ssacli'   : 120,
+                    'storcli64': 120,
+                    'storcli'  : 120,
+                    'perccli64': 120,
+                    'perccli'  : 120,
+                    'lsblk'    : 30,
+                    'lshw'     : 120,
+                    '/usr/sbin/virt-what' : 30,
+                    'nvme-ioctl' : 10}    #NVMe admin commands run in the kernel, see command_runner.read_log_page
+
+#seconds the output of a command can be reused for (see command_cache), by program and option, None for any options
+COMMAND_CACHE_TTLS = {('smartctl', '-H')    : 60,       #health
+                      ('smartctl', '-a')    : 600,      #SMART attributes
+                      ('smartctl', '-i')    : 3600,     #identity
+                      ('nvme-ioctl', None)  : 600,      #NVMe SMART log page
+                      ('ssacli', None)      : 60,       #RAID status
+                      ('storcli64', None)   : 60,
+                      ('storcli', None)     : 60,
+                      ('perccli64', None)   : 60,
+                      ('perccli', None)     : 60}
+
+class command_cache():
+    '''
+    on disk cache of command output shared by all runs, so a run straight after another one (eg from cron, and by hand)
+    reuses it's smartctl and RAID controller output, rather than running them again
+    ttls is a dict of (program, option): seconds the output can be reused for, commands that don't match aren't cached
+    commands on a /dev device are also keyed by the device's fingerprint, so a swapped drive doesn't get the old drive's output,
+    and commands for a physical drive behind a RAID controller by it's serial number (see raid_member_serial)
+    a run collecting an entry holds a lock on it, other runs wait for that rather than running the same command at the same time
+    expired entries are removed when new ones are saved, at most every PRUNE_INTERVAL seconds
+    '''
+    PRUNE_INTERVAL = 600
+    
+    def __init__(self, directory=None, ttls=COMMAND_CACHE_TTLS):
+        self.directory = directory or os.path.join(default_cache_dir(), 'commands')
+        self.ttls = ttls
+        self.pruned = 0
+        os.makedirs(self.directory, exist_ok=True)
+        
+    def ttl(self, cmd):
+        '''
+        returns how long the output of cmd (a list) can be reused for, or None if it isn't cached
+        '''
+        if is_raid_member_command(cmd) and raid_member_serial(cmd) is None:
+            #can't tell if the physical drive has been swapped
+            return None
+        program = os.path.basename(cmd[0])
+        for (name, option), ttl in self.ttls.items():
+            if name == program and (option is None or option in cmd):
+                return ttl
+        return None
+        
+    def path(self, cmd):
+        fingerprints = [device_fingerprint(arg) for arg in cmd if arg.startswith('/dev/')]
+        if is_raid_member_command(cmd):
+            fingerprints.append(raid_member_serial(cmd) or '')
+        return fixture_file(self.directory, list(cmd) + fingerprints)
+        
+    def get(self, path, ttl):
+        '''
+        returns the entry saved in path (see put) if it's less than ttl seconds old, else None
+        '''
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not 0 <= time.time() - entry.get('time', 0) <= ttl:
+            return None
+        return entry
+        
+    def put(self, path, cmd, output, returncode):
+        '''
+        save the output (bytes) and exit code of cmd in path, and return the entry
+        '''
+        entry = {'cmd'        : ' '.join(cmd),
+                 'time'       : time.time(),
+                 'returncode' : returncode,
+                 'output'     : output.decode('utf8', 'surrogateescape')}
+        temp_file = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump(entry, f)
+            os.replace(temp_file, path)
+        except OSError as e:
+            log.warning('could not cache output of %s: %s' % (' '.join(cmd), e))
+        if entry['time'] - self.pruned > self.PRUNE_INTERVAL:
+            self.prune(entry['time'])
+        return entry
+        
+    def prune(self, now=None):
+        '''
+        remove the entries (and left over temporary files) older than the longest ttl, and their lock files if no run holds them
+        '''
+        now = time.time() if now is None else now
+        self.pruned = now
+        max_age = max(self.ttls.values())
+        try:
+            names = os.listdir(self.directory)
+        except OSError as e:
+            log.warning('could not clean up command cache: %s' % e)
+            return
+        removed = 0
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if now - os.path.getmtime(path) <= max_age:
+                    continue
+                if name.endswith('.lock'):
+                    fd = self.try_lock(path[:-len('.lock')])
+                    if fd is None:
+                        continue
+                    try:
+                        os.remove(path)
+                    finally:
+                        self.unlock(fd)
+                else:
+                    os.remove(path)
+                removed += 1
+            except OSError:
+                pass    #removed by another run
+        if removed:
+            log.debug('removed %d expired command cache files' % removed)
+        
+    def try_lock(self, path):
+        '''
+        returns a locked file descriptor for path, or None if another run has it locked, release it with unlock
+        '''
+        fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+        
+    def lock(self, path, timeout=None):
+        '''
+        returns a locked file descriptor for path, waiting up to timeout seconds for another run to finish with it,
+        or None if it timed out
+        '''
+        deadline = time.time() + (timeout or 0)
+        while True:
+            fd = self.try_lock(path)
+            if fd is not None or time.time() >= deadline:
+                return fd
+            time.sleep(0.05)
+            
+    def unlock(self, fd):
+        if fd is not None:
+            os.close(fd)
+            
+    def entry_output(self, entry):
+        '''
+        returns the output (bytes) of a cache entry, or raises CalledProcessError like the command did
+        '''
+        output = entry['output'].encode('utf8', 'surrogateescape')
+        if entry['returncode'] != 0:
+            raise CalledProcessError(entry['returncode'], entry['cmd'].split(), output)
+        return output
+        
+class command_runner():
+    '''
+    asyncio based runner for all the external commands
+    The event loop runs in it's own thread, so commands can be run from any thread (or several at once),
+    no more than max_running commands are run at the same time, and each command has a timeout.
+    Commands that time out (or are cancelled) are killed, along with any children they started.
+    If record is a directory, the output, exit code and latency of each command is saved there (see replay_runner)
+    If cache is a command_cache, recent output of the same command is reused, from this or another run
+    If deadline is set (a time.time()), no command runs past it, commands still running then are killed and raise TimeoutExpired
+    stats has the count, total/max latency, output bytes, errors, timeouts and cache hits for each program run
+    '''
+    def __init__(self, max_running=8, timeouts=COMMAND_TIMEOUTS, timeout=None, record=None, cache=None):
+        self.max_running = max_running
+        self.timeouts = timeouts
+        self.timeout = timeout  #overrides timeouts if set
+        self.record = record
+        self.cache = cache
+        self.deadline = None
+        self.stats = {}
+        self.pending = set()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='commands', daemon=True)
+        self.thread.start()
+        self.semaphore = self.call_soon(self.setup()).result()
+        
+    async def setup(self):
+        return asyncio.Semaphore(self.max_running)
+        
+    def call_soon(self, coro):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        return future
+        
+    def get_timeout(self, cmd, timeout=None):
+        '''
+        returns the timeout for cmd, timeout if it's given, else the default for the program, cut short by the deadline
+        '''
+        if timeout is None:
+            timeout = self.timeout if self.timeout is not None else self.timeouts.get(cmd[0])
+        remaining = self.remaining()
+        if remaining is not None and (timeout is None or remaining < timeout):
+            return remaining
+        return timeout
+        
+    def remaining(self):
+        '''
+        returns the seconds left before the deadline, or None if there is no deadline
+        '''
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+        
+    def which(self, programs):
+        '''
+        returns the first of programs that is installed, or None
+        '''
+        for program in programs:
+            if shutil.which(program):
+                return program
+        return None
+        
+    def account(self, cmd, latency, output=b'', returncode=0):
+        '''
+        add a command to stats, returncode is None if it timed out
+        '''
+        stats = self.program_stats(cmd)
+        stats['count'] += 1
+        stats['total'] += latency
+        if latency >= stats['max']:
+            stats['max'] = latency
+            stats['slowest'] = ' '.join(cmd)
+        stats['bytes'] += len(output)
+        if returncode is None:
+            stats['timeouts'] += 1
+        elif returncode != 0:
+            stats['errors'] += 1
+            
+    def program_stats(self, cmd):
+        return self.stats.setdefault(os.path.basename(cmd[0]), {'count': 0, 'total': 0.0, 'max': 0.0, 'slowest': None,
+                                                                'bytes': 0, 'errors': 0, 'timeouts': 0, 'cached': 0})
+                                                                
+    def cache_hit(self, cmd, entry):
+        self.program_stats(cmd)['cached'] += 1
+        log.debug('command: %s, using output cached %.0fs ago' % (' '.join(cmd), time.time() - entry['time']))
+        return self.cache.entry_output(entry)
+        
+    #seconds to wait for a killed command to exit, one stuck in the kernel (eg on a dead disk) can't be killed, so it's left behind
+    KILL_WAIT = 5
+    
+    async def kill(self, proc):
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        try:
+            await asyncio.wait_for(proc.wait(), self.KILL_WAIT)
+        except asyncio.TimeoutError:
+            log.warning('process %s did not exit after being killed, leaving it' % proc.pid)
+            
+    async def run_async(self, cmd_string, timeout=None):
+        cmd = cmd_string.split() if isinstance(cmd_string, str) else list(cmd_string)
+        timeout = self.get_timeout(cmd, timeout)
+        ttl = self.cache.ttl(cmd) if self.cache else None
+        if ttl is None:
+            return await self.execute(cmd, timeout)
+        path = self.cache.path(cmd)
+        entry = self.cache.get(path, ttl)
+        if entry is not None:
+            return self.cache_hit(cmd, entry)
+        #wait (without blocking the event loop) for any other run that is collecting the same output
+        deadline = time.time() + (60 if timeout is None else timeout)
+        fd = self.cache.try_lock(path)
+        while fd is None and time.time() < deadline:
+            await asyncio.sleep(0.05)
+            fd = self.cache.try_lock(path)
+        try:
+            entry = self.cache.get(path, ttl)
+            if entry is not None:
+                return self.cache_hit(cmd, entry)
+            try:
+                output = await self.execute(cmd, timeout)
+            except CalledProcessError as e:
+                self.cache.put(path, cmd, e.output, e.returncode)
+                raise
+            self.cache.put(path, cmd, output, 0)
+            return output
+        finally:
+            self.cache.unlock(fd)
+            
+    def out_of_time(self, cmd):
+        log.warning('command: %s not run, out of time' % ' '.join(cmd))
+        self.account(cmd, 0, returncode=None)
+        raise TimeoutExpired(cmd, 0)
+        
+    async def execute(self, cmd, timeout):
+        try:
+            #waiting for a free slot counts against the deadline too
+            await asyncio.wait_for(self.semaphore.acquire(), self.remaining())
+        except asyncio.TimeoutError:
+            self.out_of_time(cmd)
+        try:
+            timeout = self.get_timeout(cmd, timeout)
+            if timeout is not None and timeout <= 0:
+                self.out_of_time(cmd)
+            start = time.time()
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, start_new_session=True)
+            try:
+                output, _ = await asyncio.wait_for(proc.communicate(), timeout)
+            except asyncio.TimeoutError:
+                log.warning('command: %s timed out after %.3gs, killing it' % (' '.join(cmd), timeout))
+                await self.kill(proc)
+                self.account(cmd, time.time() - start, returncode=None)
+                if self.record:
+                    save_fixture(self.record, cmd, b'', None, time.time() - start)
+                raise TimeoutExpired(cmd, timeout)
+            except asyncio.CancelledError:
+                await self.kill(proc)
+                raise
+        finally:
+            self.semaphore.release()
+        self.account(cmd, time.time() - start, output, proc.returncode)
+        if self.record:
+            save_fixture(self.record, cmd, output, proc.returncode, time.time() - start)
+        if proc.returncode != 0:
+            raise CalledProcessError(proc.returncode, cmd, output)
+        return output
+        
+    def read_log_page(self, device, log_id=0x02, length=512):
+        '''
+        returns an NVMe log page (bytes) read from device with the admin passthrough ioctl, in the calling thread
+        it is accounted and recorded like a command, 'nvme-ioctl get-log-page 0x02 /dev/nvme0n1'
+        '''
+        cmd = ['nvme-ioctl', 'get-log-page', '0x%02x' % log_id, device]
+        ttl = self.cache.ttl(cmd) if self.cache else None
+        if ttl is None:
+            return self.execute_log_page(cmd, device, log_id, length)
+        path = self.cache.path(cmd)
+        entry = self.cache.get(path, ttl)
+        if entry is not None:
+            return self.cache_hit(cmd, entry)
+        fd = self.cache.lock(path, self.get_timeout(cmd))
+        try:
+            entry = self.cache.get(path, ttl)
+            if entry is not None:
+                return self.cache_hit(cmd, entry)
+            output = self.execute_log_page(cmd, device, log_id, length)
+            self.cache.put(path, cmd, output, 0)
+            return output
+        finally:
+            self.cache.unlock(fd)
+            
+    def execute_log_page(self, cmd, device, log_id, length):
+        start = time.time()
+        timeout = self.get_timeout(cmd)
+        try:
+            if timeout is not None and timeout <= 0:
+                raise OSError(errno.ETIMEDOUT, 'out of time', device)
+            output = nvme_get_log_page(device, log_id, length, timeout)
+        except OSError as e:
+            self.account(cmd, time.time() - start, returncode=e.errno or -1)
+            if self.record:
+                save_fixture(self.record, cmd, b'', e.errno or -1, time.time() - start)
+            raise
+        self.account(cmd, time.time() - start, output)
+        if self.record:
+            save_fixture(self.record, cmd, output, 0, time.time() - start)
+        return output
+        
+    def run(self, cmd_string, timeout=None):
+        '''
+        run a command and return it's output, works like check_output(), but raises TimeoutExpired if the command hangs
+        '''
+        future = self.call_soon(self.run_async(cmd_string, timeout))
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            future.cancel()
+            raise
+        
+    def run_all(self, cmd_strings, timeout=None):
+        '''
+        run several commands at the same time, returns a list of outputs (or the exception raised) in the same order
+        '''
+        async def gather():
+            return await asyncio.gather(*[self.run_async(cmd_string, timeout) for cmd_string in cmd_strings], return_exceptions=True)
+        future = self.call_soon(gather())
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            future.cancel()
+            raise
+        
+    def cancel_all(self):
+        for future in self.pending.copy():
+            future.cancel()
+            
+    def stop(self):
+        self.cancel_all()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5)
+        
+class replay_runner(command_runner):
+    '''
+    serves the output of commands saved by command_runner(record=directory), instead of running them
+    latency is multiplied by the recorded latency of each command to simulate it (0 to return at once)
+    a command that wasn't recorded raises FileNotFoundError, like a program that isn't installed
+    '''
+    def __init__(self, directory, latency=0, max_running=8, timeouts=COMMAND_TIMEOUTS, timeout=None):
+        self.directory = directory
+        self.latency = latency
+        self.calls = []     #the commands served, in order
+        super().__init__(max_running, timeouts, timeout)
+        
+    async def run_async(self, cmd_string, timeout=None):
+        cmd = cmd_string.split() if isinstance(cmd_string, str) else list(cmd_string)
+        timeout = self.get_timeout(cmd, timeout)
+        fixture = load_fixture(self.directory, cmd)
+        self.calls.append(' '.join(cmd))
+        async with self.semaphore:
+            delay = fixture['latency'] * self.latency
+            if fixture['returncode'] is None or (timeout is not None and delay > timeout):
+                await asyncio.sleep(min(delay, timeout) if timeout is not None else delay)
+                self.account(cmd, min(delay, timeout) if timeout is not None else delay, returncode=None)
+                raise TimeoutExpired(cmd, timeout)
+            await asyncio.sleep(delay)
+        output = fixture['output'].encode('utf8', 'surrogateescape')
+        self.account(cmd, delay, output, fixture['returncode'])
+        if fixture['returncode'] != 0:
+            raise CalledProcessError(fixture['returncode'], cmd, output)
+        return output
+        
+    def which(self, programs):
+        '''
+        returns the first of programs that has recorded commands, or None
+        '''
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return None
+        for program in programs:
+            if any(name.startswith(program + '_') for name in names):
+                return program
+        return None
+        
+    def read_log_page(self, device, log_id=0x02, length=512):
+        cmd = ['nvme-ioctl', 'get-log-page', '0x%02x' % log_id, device]
+        fixture = load_fixture(self.directory, cmd)
+        self.calls.append(' '.join(cmd))
+        time.sleep(fixture['latency'] * self.latency)
+        output = fixture['output'].encode('utf8', 'surrogateescape')
+        self.account(cmd, fixture['latency'] * self.latency, output, fixture['returncode'])
+        if fixture['returncode'] != 0:
+            raise OSError(fixture['returncode'], os.strerror(fixture['returncode']), device)
+        return output
+        
+def fixture_file(directory, cmd):
+    '''
+    returns the path of the file the recorded output of cmd (a list) is saved in
+    '''
+    cmd_string = ' '.join(cmd)
+    name = re.sub(r'[^\w.-]+', '_', cmd_string).strip('_')[:80]
+    return os.path.join(directory, '%s-%s.json' % (name, hashlib.sha1(cmd_string.encode('utf8')).hexdigest()[:8]))
+    
+def save_fixture(directory, cmd, output, returncode, latency):
+    '''
+    save the output (bytes), exit code (None if it timed out) and latency (seconds) of cmd (a list) in directory
+    '''
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(fixture_file(directory, cmd), 'w') as f:
+            json.dump({'cmd'        : ' '.join(cmd),
+                       'returncode' : returncode,
+                       'latency'    : round(latency, 4),
+                       'output'     : output.decode('utf8', 'surrogateescape')}, f, indent=2)
+    except OSError as e:
+        log.warning('could not record output of %s: %s' % (' '.join(cmd), e))
+        
+def load_fixture(directory, cmd):
+    path = fixture_file(directory, cmd)
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise FileNotFoundError(2, 'no recorded output for %s' % ' '.join(cmd), path)
+        
+class stage_timer():
+    '''
+    times the stages of a run (eg get_drives), for the timing report
+    each stage has the number of times it ran, and the total wall and CPU time
+    if profile is a cProfile.Profile, it is only enabled during the stages, so it shows the parsing, not the waiting
+    '''
+    def __init__(self, profile=None):
+        self.start = time.time()
+        self.stages = {}
+        self.profile = profile
+        self.depth = 0
+        self.lock = threading.Lock()
+        
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        cpu_start = time.process_time()
+        with self.lock:
+            self.depth += 1
+            if self.profile and self.depth == 1:
+                self.profile.enable()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.depth -= 1
+                if self.profile and self.depth == 0:
+                    self.profile.disable()
+                stage = self.stages.setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0})
+                stage['count'] += 1
+                stage['wall'] += time.time() - start
+                stage['cpu'] += time.process_time() - cpu_start
+                
+    def report(self, command_stats=None):
+        '''
+        returns the timing report, a dict of the stages and the stats for each external command
+        '''
+        return {'version'  : __version__,
+                'started'  : self.start,
+                'wall'     : time.time() - self.start,
+                'cpu'      : time.process_time(),
+                'stages'   : self.stages,
+                'commands' : command_stats or {}}
+                
+    def profile_stats(self, profile_file, lines=25):
+        '''
+        save the profile to profile_file (for pstats or snakeviz etc), and return the top lines by time as text
+        '''
+        self.profile.dump_stats(profile_file)
+        text = io.StringIO()
+        pstats.Stats(self.profile, stream=text).sort_stats('tottime').print_stats(lines)
+        return text.getvalue()
+        
+timer = stage_timer()
+
+runner = None
+nvme_ioctl = True   #read NVMe SMART data with the admin ioctl, rather than smartctl
+discovery = 'sysfs' #find the drives from sysfs, or 'lshw' to use lsblk and lshw
+device_timeout = None   #seconds smartctl has to read a drive, None for the smartctl command timeout
+
+def get_runner():
+    global runner
+    if runner is None:
+        runner = command_runner()
+    return runner
+    
+def run_command(cmd_string, timeout=None):
+    return get_runner().run(cmd_string, timeout)
+    
+def run_commands(cmd_strings, timeout=None):
+    return get_runner().run_all(cmd_strings, timeout)
+    
+def raise_error(result):
+    '''
+    raise result if it is an exception returned by run_commands(), else return it
+    '''
+    if isinstance(result, BaseException):
+        raise result
+    return result
+
+def human_size(size_bytes):
+    """
+    format a size in bytes into a 'human' file size, e.g. bytes, KB, MB, GB, TB, PB
+    Note that bytes/KB will be reported in whole numbers but MB and above will have greater precision
+    e.g. 1 byte, 43 bytes, 443 KB, 4.3 MB, 4.43 GB, etc
+    """
+    if size_bytes == 1:
+        # because I really hate unnecessary plurals
+        return "1 byte"
+
+    suffixes_table = [('bytes',0),('KB',0),('MB',1),('GB',2),('TB',2), ('PB',2)]
+
+    num = float(size_bytes)
+    for suffix, precision in suffixes_table:
+        if num < 1024.0:
+            break
+        num /= 1024.0
+
+    if precision == 0:
+        formatted_size = "%d" % num
+    else:
+        formatted_size = str(round(num, ndigits=precision))
+
+    return "%s %s" % (formatted_size, suffix)
+    
+#values reported by SSD's in last column
+LAST_COLUMN = [ 'Airflow_Temperature_Cel',
+                'Temperature_Celsius',
+                'Total_LBAs_Written',
+                'Host_Writes_32MiB',
+                'Power_On_Hours',
+                'SMART Health Status',
+                'SMART overall-health']
+                
+#text to match in the smartctl output for each value, the first line that matches (and has a value) is used
+SMART_MATCHES = {'temp'          : ['Temperature'],
+                 'bytes_written' : ['Total_LBAs_Written', 'Data Units Written', 'write:', 'Host_Writes_32MiB'],
+                 'smart_status'  : ['SMART Health Status', 'SMART overall-health'],
+                 'power_on_hrs'  : ['Power_On_Hours', 'Power On Hours'],
+                 'life'          : ['Percentage Used','Wear_Leveling_Count', 'Remaining_Lifetime_Perc'],
+                 'spare'         : ['Available Spare', 'Available_Reservd_Space']}
+                 
+SSD_VALUES = ['life', 'spare']
+                 
+class smart_record():
+    '''
+    SMART values for one physical drive
+    the values are formatted for display, raw is a dict of value name: number (eg bytes_written in bytes) where known
+    '''
+    __slots__ = ['temp', 'bytes_written', 'smart_status', 'power_on_hrs', 'life', 'spare', 'raw']
+    
+    def __init__(self, temp=None, bytes_written=None, smart_status=None, power_on_hrs=None, life=None, spare=None, raw=None):
+        self.temp = temp
+        self.bytes_written = bytes_written
+        self.smart_status = smart_status
+        self.power_on_hrs = power_on_hrs
+        self.life = life
+        self.spare = spare
+        self.raw = raw if raw is not None else {}
+        
+#the status of a drive that didn't answer in time, and the exit code of a --summary run if that's the only problem
+SMART_TIMEOUT = 'unknown/timeout'
+EXIT_TIMEOUT = 3
+
+class drive_record(smart_record):
+    '''
+    the latest SMART values for one physical drive, updated in place on each poll
+    drive_no is None for a plain disk, or the index of the physical drive in a RAID volume
+    '''
+    __slots__ = ['name', 'drive_no', 'ssd']
+    
+    def __init__(self, name, drive_no=None, life=None, spare=None):
+        super().__init__(life=life, spare=spare)
+        self.name = name
+        self.drive_no = drive_no
+        self.ssd = False
+        
+    def update(self, record, ssd=False):
+        '''
+        copy the values from record (a smart_record), life and spare are only kept for SSD's
+        '''
+        self.raw = record.raw
+        self.temp = record.temp
+        self.bytes_written = record.bytes_written
+        self.smart_status = record.smart_status
+        self.power_on_hrs = record.power_on_hrs
+        if ssd:
+            self.ssd = True
+            self.life = record.life
+            self.spare = record.spare
+            
+    def label(self):
+        return self.name if self.drive_no is None else '%s(%d)' % (self.name, self.drive_no)
+        
+    def text(self):
+        '''
+        returns the values formatted for the log and summary
+        '''
+        if self.smart_status == SMART_TIMEOUT:
+            return 'Drive: %s, Status: %s' % (self.label(), self.smart_status)
+        if self.ssd:
+            ssd_text = ', Available Spare: {}%, Remaining life: {}%'.format(self.spare, self.life)
+        else:
+            ssd_text = ''
+        return 'Drive: %s, Power On: %s, Temp: %s, LBA: %s, Status: %s%s' % (self.label(),
+                                                                               self.power_on_hrs if self.power_on_hrs is not None else 'unknown',
+                                                                               self.temp,
+                                                                               self.bytes_written if self.bytes_written is not None else 'unknown',
+                                                                               self.smart_status,
+                                                                               ssd_text)
+                                                                               
+    def as_dict(self):
+        values = {'drive_no': self.drive_no, 'ssd': self.ssd, 'raw': self.raw}
+        for name in SMART_MATCHES.keys():
+            values[name] = getattr(self, name)
+        return values
+        
+class smart_parser():
+    '''
+    reads smartctl text output in one pass, filling in all the values at the same time
+    matches is a dict of value name: list of text to match (case insensitive)
+    '''
+    LBA_size = 512
+    
+    def __init__(self, matches=SMART_MATCHES):
+        self.matches = {name : re.compile('|'.join(re.escape(text) for text in texts), re.IGNORECASE) for name, texts in matches.items()}
+        self.any_match = re.compile('|'.join(re.escape(text) for texts in matches.values() for text in texts), re.IGNORECASE)
+        
+    def parse(self, lines, ssd=False):
+        '''
+        returns a smart_record from smartctl output lines, life and spare are only read for SSD's
+        '''
+        raw = {}
+        values = self.parse_values(lines, [name for name in self.matches.keys() if ssd or name not in SSD_VALUES], raw)
+        return smart_record(raw=raw, **values)
+        
+    def parse_values(self, lines, names=None, raw=None):
+        '''
+        returns a dict of value name: value (or None if not found)
+        if raw is a dict, it is updated with the numeric values found
+        '''
+        wanted = list(names if names is not None else self.matches.keys())
+        values = dict.fromkeys(wanted)
+        if raw is None:
+            raw = {}
+        last_column = LAST_COLUMN[:]
+        for line_num, text in enumerate(lines):
+            if len(text) > 0:
+                if 'Model Family' in text and 'Seagate Constellation' in text:
+                    last_column.remove('Temperature_Celsius')
+                if not self.any_match.search(text):
+                    continue
+                names = [name for name in wanted if self.matches[name].search(text)]
+                if not names:
+                    continue
+                found, val, number = self.line_value(lines, line_num, last_column)
+                if found:
+                    for name in names:
+                        values[name] = val
+                        if number is not None:
+                            raw[name] = number
+                        wanted.remove(name)
+                    if not wanted:
+                        break
+        return values
+        
+    def line_value(self, lines, line_num, last_column):
+        '''
+        returns (True, value, number) for the value in lines[line_num], or (False, None, None) if there isn't one
+        number is the value as a number (eg bytes rather than human size), or None
+        '''
+        text = lines[line_num]
+        info = text.split()
+        if any(check in text for check in last_column):
+            if 'SMART Health Status' in text:
+                return True, info[-1], None
+            if 'SMART overall-health' in text:
+                val = info[-1]
+                if 'passed' in val.lower():
+                    val = 'OK'
+                return True, val, None
+            val = None
+            for data in reversed(info):
+                try:
+                    val = int(data)
+                    break
+                except ValueError:
+                    pass
+            if val is None:
+                return True, val, None
+            if 'Total_LBAs_Written' in text:
+                val = val*self.LBA_size
+            if 'Host_Writes_32MiB' in text:
+                val = val*32*1024*1000
+            number = val
+            if val > 99999:
+                val = human_size(val)
+            return True, val, number
+        if 'Available Spare' in text:
+            #SSD Spare capacity Available
+            val = info[-1].replace("%","")
+            return True, val, to_number(val)
+        if 'Percentage Used' in text:
+            #SSD life remaining
+            val = 100 - int(info[-1].replace("%",""))
+            return True, str(val), val
+        if 'Data Units Written' in text:
+            val = info[-2]+' '+info[-1]
+            return True, val.replace('[','').replace(']',''), to_number(info[-3], 512000)    #units of 1000 512 byte blocks
+        elif 'write:' in text:
+            number = float(info[-2])*1000000000
+            return True, human_size(number), int(number)
+        if '(hours)' in text and line_num+1 < len(lines):
+            #power on hours is on the next line
+            if 'in progress' in lines[line_num+1]:
+                return True, 'pending', None
+            line_text = lines[line_num+1].split()
+            for column, data in enumerate(line_text):
+                if data.isdigit() and column > 2: #skip test number
+                    return True, data, int(data)
+        for count, data in enumerate(info):
+            data = data.replace('%','').replace(',','')
+            if data.isdigit() and count > 0:
+                return True, int(data), int(data)
+        return False, None, None
+        
+def to_number(text, multiplier=1):
+    '''
+    returns text (eg '1,234') as an int times multiplier, or None if it isn't a number
+    '''
+    try:
+        return int(str(text).replace(',','')) * multiplier
+    except ValueError:
+        return None
+        
+def si_size(size_bytes):
+    '''
+    format a size in bytes to 3 significant figures in SI units, the same way smartctl does, e.g. 703 GB, 9.66 TB, 14.0 TB
+    '''
+    num = float(size_bytes)
+    for suffix in ['B', 'KB', 'MB', 'GB', 'TB', 'PB']:
+        if round(num) < 1000:
+            break
+        num /= 1000.0
+    precision = 2 if num < 9.995 else 1 if num < 99.95 else 0
+    return '%.*f %s' % (precision, num, suffix)
+    
+NVME_IOCTL_ADMIN_CMD = 0xC0484E41     #_IOWR('N', 0x41, struct nvme_admin_cmd)
+NVME_ADMIN_GET_LOG_PAGE = 0x02
+NVME_LOG_SMART = 0x02               #SMART / Health Information
+#struct nvme_admin_cmd: opcode, flags, rsvd1, nsid, cdw2, cdw3, metadata, addr, metadata_len, data_len, cdw10-15, timeout_ms, result
+NVME_ADMIN_CMD = struct.Struct('=BBHIIIQQIIIIIIIIII')
+
+def nvme_get_log_page(device, log_id=NVME_LOG_SMART, length=512, timeout=None):
+    '''
+    returns length bytes of log page log_id from an NVMe device (eg /dev/nvme0n1), with the admin passthrough ioctl
+    needs root, raises OSError if the device can't be opened or the command fails
+    '''
+    data = ctypes.create_string_buffer(length)
+    dwords = length // 4 - 1
+    cmd = bytearray(NVME_ADMIN_CMD.pack(NVME_ADMIN_GET_LOG_PAGE, 0, 0, 0xFFFFFFFF, 0, 0, 0, ctypes.addressof(data), 0, length,
+                                        (dwords & 0xFFFF) << 16 | log_id, dwords >> 16, 0, 0, 0, 0, max(int(timeout * 1000), 1) if timeout else 0, 0))
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        status = fcntl.ioctl(fd, NVME_IOCTL_ADMIN_CMD, cmd)
+    finally:
+        os.close(fd)
+    if status != 0:
+        raise OSError(errno.EIO, 'NVMe get log page 0x%02x failed, status 0x%x' % (log_id, status), device)
+    return data.raw
+    
+def parse_nvme_smart_log(data, ssd=True):
+    '''
+    returns a smart_record from an NVMe SMART / Health Information log page, with the values formatted the same way as smart_parser does
+    the numbers are little endian, the counters are 16 bytes
+    '''
+    if len(data) < 144:
+        raise ValueError('NVMe SMART log page is too short (%d bytes)' % len(data))
+        
+    def number(offset, size=16):
+        return int.from_bytes(data[offset:offset + size], 'little')
+        
+    record = smart_record()
+    record.smart_status = 'OK' if data[0] == 0 else 'FAILED!'    #critical warning bits
+    kelvin = number(1, 2)
+    if kelvin:
+        record.temp = record.raw['temp'] = kelvin - 273
+    written = number(48) * 512000    #units of 1000 512 byte blocks
+    record.bytes_written = si_size(written)
+    record.raw['bytes_written'] = written
+    record.power_on_hrs = record.raw['power_on_hrs'] = number(128)
+    if ssd:
+        record.raw['spare'] = data[3]
+        record.spare = str(data[3])
+        record.raw['life'] = 100 - data[5]     #percentage used
+        record.life = str(record.raw['life'])
+    return record
+    
+class smart_json_parser():
+    '''
+    reads smartctl -j JSON output into a smart_record, with the values formatted the same way as smart_parser does
+    '''
+    ata_matches = {'bytes_written' : ['Total_LBAs_Written', 'Host_Writes_32MiB'],
+                   'life'          : ['Wear_Leveling_Count', 'Remaining_Lifetime_Perc'],
+                   'spare'         : ['Available_Reservd_Space']}
+    ata_multipliers = {'Total_LBAs_Written' : smart_parser.LBA_size,
+                       'Host_Writes_32MiB'  : 32*1024*1000}
+    
+    def parse(self, data, ssd=False):
+        record = smart_record()
+        record.temp = data.get('temperature', {}).get('current')
+        record.power_on_hrs = data.get('power_on_time', {}).get('hours')
+        if 'smart_status' in data:
+            record.smart_status = 'OK' if data['smart_status'].get('passed') else 'FAILED!'
+            
+        for attribute in data.get('ata_smart_attributes', {}).get('table', []):
+            name = attribute.get('name')
+            if record.bytes_written is None and name in self.ata_matches['bytes_written']:
+                self.set_bytes_written(record, attribute['raw']['value'] * self.ata_multipliers[name])
+            if ssd and record.life is None and name in self.ata_matches['life']:
+                record.life = record.raw['life'] = attribute['value']
+            if ssd and record.spare is None and name in self.ata_matches['spare']:
+                record.spare = record.raw['spare'] = attribute['value']
+                
+        nvme_log = data.get('nvme_smart_health_information_log')
+        if nvme_log:
+            if record.temp is None:
+                record.temp = nvme_log.get('temperature')
+            if record.power_on_hrs is None:
+                record.power_on_hrs = nvme_log.get('power_on_hours')
+            if 'data_units_written' in nvme_log:
+                number = nvme_log['data_units_written'] * 512000    #units of 1000 512 byte blocks
+                record.bytes_written = si_size(number)
+                record.raw['bytes_written'] = number
+            if ssd and 'percentage_used' in nvme_log:
+                record.raw['life'] = 100 - nvme_log['percentage_used']
+                record.life = str(record.raw['life'])
+            if ssd and 'available_spare' in nvme_log:
+                record.raw['spare'] = nvme_log['available_spare']
+                record.spare = str(record.raw['spare'])
+                
+        scsi_write = data.get('scsi_error_counter_log', {}).get('write', {})
+        if record.bytes_written is None and 'gigabytes_processed' in scsi_write:
+            number = int(float(scsi_write['gigabytes_processed'])*1000000000)
+            record.bytes_written = human_size(number)
+            record.raw['bytes_written'] = number
+            
+        for name in ['temp', 'power_on_hrs']:
+            if getattr(record, name) is not None:
+                record.raw[name] = getattr(record, name)
+        return record
+        
+    def set_bytes_written(self, record, number):
+        record.raw['bytes_written'] = number
+        record.bytes_written = human_size(number) if number > 99999 else number
+        
+def smartctl_version():
+    '''
+    returns the installed smartctl version as a tuple eg (7, 0), or (0, 0) if it can't be found
+    '''
+    try:
+        text = run_command('smartctl -V').decode('utf8')
+    except (CalledProcessError, TimeoutExpired, OSError) as e:
+        log.warning('could not get smartctl version: %s' % e)
+        return (0, 0)
+    match = re.search(r'smartctl\s+(\d+)\.(\d+)', text)
+    if match:
+        return (int(match.group(1)), int(match.group(2)))
+    return (0, 0)
+    
+def smartctl_supports_json():
+    #smartctl has had -j since 7.0
+    return smartctl_version() >= (7, 0)
+        
+DRIVEDB_URL = 'https://sourceforge.net/p/smartmontools/code/HEAD/tree/trunk/smartmontools/drivedb.h?format=raw'
+
+def default_cache_dir():
+    if hasattr(os, 'geteuid') and os.geteuid() == 0:
+        return '/var/cache/drive_info'
+    return os.path.join(os.path.expanduser('~'), '.cache', 'drive_info')
+    
+class drive_database():
+    '''
+    keeps smartctl's drive database (drivedb.h) in cache_dir, with it's version and when it was downloaded/checked in drivedb.json
+    refresh() downloads it again if it's older than max_age days, using If-Modified-Since so an unchanged file isn't downloaded
+    a failed download isn't tried again for RETRY_AFTER seconds, so a host without network doesn't try on every run
+    option is the smartctl -B argument, worked out once, it's '' if there is no drivedb.h (so smartctl uses it's own)
+    '''
+    RETRY_AFTER = 6 * 3600
+    
+    def __init__(self, cache_dir=None, max_age=7, url=DRIVEDB_URL, timeout=30):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.path = os.path.join(self.cache_dir, 'drivedb.h')
+        self.meta_path = os.path.join(self.cache_dir, 'drivedb.json')
+        self.max_age = max_age
+        self.url = url
+        self.timeout = timeout
+        self.thread = None
+        self.meta = self.load_meta()
+        self.option = self.get_option()
+        
+    def load_meta(self):
+        try:
+            with open(self.meta_path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+            
+    def get_option(self):
+        if os.path.isfile(self.path):
+            return '-B %s' % self.path
+        if os.path.isfile('drivedb.h'):
+            #drivedb.h downloaded to the current directory by older versions
+            return '-B drivedb.h'
+        return ''
+        
+    def needs_refresh(self, now=None):
+        now = time.time() if now is None else now
+        if now - self.meta.get('attempted', 0) < min(self.RETRY_AFTER, self.max_age * 86400):
+            #tried recently and it didn't work (or is still going)
+            return False
+        return not os.path.isfile(self.path) or now - self.meta.get('checked', 0) > self.max_age * 86400
+        
+    def version(self, text):
+        match = re.search(r'\$Id: drivedb.h (\d+) (\S+)', text)
+        return '%s %s' % match.groups() if match else None
+        
+    def refresh(self):
+        '''
+        download drivedb.h if it has changed, returns True if a new one was saved
+        errors are logged, and the file already in the cache (if any) is kept
+        '''
+        request = urllib.request.Request(self.url, headers={'User-Agent': 'drive_info.py/%s' % __version__})
+        if os.path.isfile(self.path) and self.meta.get('last_modified'):
+            request.add_header('If-Modified-Since', self.meta['last_modified'])
+        #saved before downloading, so an attempt that fails, hangs or is cut off by the program exiting still counts
+        self.meta = dict(self.meta, attempted=time.time())
+        self.save_meta(self.meta)
+        meta = dict(self.meta)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                text = response.read().decode('utf8')
+                last_modified = response.headers.get('Last-Modified') or formatdate(usegmt=True)
+            if 'drivedb' not in text or '{' not in text:
+                raise ValueError('download does not look like drivedb.h')
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(text)
+            os.replace(self.path + '.tmp', self.path)
+            meta.update({'url': self.url, 'version': self.version(text), 'downloaded': time.time(), 'last_modified': last_modified})
+            log.info('downloaded drive database version %s to %s' % (meta['version'], self.path))
+            updated = True
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                log.warning('could not download drive database: %s' % e)
+                return False
+            log.debug('drive database %s is up to date' % meta.get('version'))
+            updated = False
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            log.warning('could not download drive database: %s' % e)
+            return False
+        meta['checked'] = time.time()
+        del meta['attempted']
+        self.save_meta(meta)
+        self.meta = meta
+        self.option = self.get_option()
+        return updated
+        
+    def save_meta(self, meta):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.meta_path + '.tmp', 'w') as f:
+                json.dump(meta, f, indent=2)
+            os.replace(self.meta_path + '.tmp', self.meta_path)
+        except OSError as e:
+            log.warning('could not save drive database info: %s' % e)
+        
+    def refresh_in_background(self):
+        '''
+        start refresh() in a thread if needed, so it never holds up reading the drives
+        '''
+        if self.needs_refresh() and not (self.thread and self.thread.is_alive()):
+            self.thread = threading.Thread(target=self.refresh, name='drivedb', daemon=True)
+            self.thread.start()
+            
+    def wait(self, timeout=None):
+        if self.thread:
+            self.thread.join(timeout)
+            
+drivedb = None
+
+def get_drive_database():
+    global drivedb
+    if drivedb is None:
+        drivedb = drive_database()
+    return drivedb
+    
+SMART_PARSER = smart_parser()
+#RAID controllers report power on hours in the self test log
+RAID_SMART_PARSER = smart_parser(dict(SMART_MATCHES, power_on_hrs=SMART_MATCHES['power_on_hrs']+['(hours)']))
+SMART_JSON_PARSER = smart_json_parser()
+
 class disk_info():
-    def __init__(self, name, drive):
+    def __init__(self, name, drive, collect=True, use_json=False, selftest=True):
         self.name = name
         self.drive = drive
-        self.num_drives = None
-        self.temp = None
-        self.life = 100
-        self.spare = 100
-        self.bytes_written = None
-        self.power_on_hrs = None
-        self.smart_status = None
-        self.ssd = False
+        self.use_json = use_json
+        self.selftest = selftest    #run a short self test if collecting at midnight
+        self.records = []           #a drive_record for each physical drive
         self.smart = False
         self.raid = False
-        self.drive_db = ''
-        if os.path.isfile('drivedb.h'):
-            self.drive_db = '-B drivedb.h'
+        self.drive_db = get_drive_database().option
         if drive['SMART']:
             self.smart = True
             if 'raid' not in drive['type'].lower():
-                self.drive_info=self.SCSI_disk_info()
+                self.records = [drive_record(name, life=100, spare=100)]
+                if collect:
+                    self.drive_info=self.SCSI_disk_info()
             else:
-                self.drive_info=self.RAID_disk_info()
                 self.raid = True
+                self.setup_raid_lists()
+                if collect:
+                    self.drive_info=self.RAID_disk_info()
                 
+    @property
+    def num_drives(self):
+        return len(self.records)
+        
     def human_size(self,size_bytes):
-        """
-        format a size in bytes into a 'human' file size, e.g. bytes, KB, MB, GB, TB, PB
-        Note that bytes/KB will be reported in whole numbers but MB and above will have greater precision
-        e.g. 1 byte, 43 bytes, 443 KB, 4.3 MB, 4.43 GB, etc
-        """
-        if size_bytes == 1:
-            # because I really hate unnecessary plurals
-            return "1 byte"
-
-        suffixes_table = [('bytes',0),('KB',0),('MB',1),('GB',2),('TB',2), ('PB',2)]
-
-        num = float(size_bytes)
-        for suffix, precision in suffixes_table:
-            if num < 1024.0:
-                break
-            num /= 1024.0
-
-        if precision == 0:
-            formatted_size = "%d" % num
-        else:
-            formatted_size = str(round(num, ndigits=precision))
-
-        return "%s %s" % (formatted_size, suffix)
+        return human_size(size_bytes)
+        
+    def record(self, drive_no=None):
+        return self.records[drive_no or 0]
+        
+    def as_dict(self):
+        '''
+        returns the drive data as a dict (for JSON), with a list of the values for each physical drive
+        '''
+        return {'name': self.name, 'type': self.drive['type'], 'raid': self.raid, 'smart': self.smart,
+                'drives': [record.as_dict() for record in self.records]}
                 
-    def get_data_from_text(self, match, lines):
-        val = None
-        LBA_size = 512
-        last_column = [ 'Airflow_Temperature_Cel',
-                        'Temperature_Celsius',
-                        'Total_LBAs_Written',
-                        'Host_Writes_32MiB',
-                        'Power_On_Hours',
-                        'SMART Health Status',
-                        'SMART overall-health'] #values reported by SSD's in last column
-        if not isinstance(match, list):
-            match = [match]
-        if not isinstance(lines, list):
-            lines = [lines]
-        for line_num, text in enumerate(lines):
-            if len(text) > 0:
-                if 'Model Family' in text and 'Seagate Constellation' in text:
-                    last_column.remove('Temperature_Celsius')
-                if any(check.lower() in text.lower() for check in match):
-                    info = text.split()
-                    if any(check in text for check in last_column):
-                        if 'SMART Health Status' in text:
-                            val = info[-1]
-                            return val
-                        if 'SMART overall-health' in text:
-                            val = info[-1]
-                            if 'passed' in val.lower():
-                                val = 'OK'
-                            return val
-                        pos = 0
-                        while pos > -len(text):
-                            pos -= 1
-                            try:
-                                val = int(info[pos])
-                                break
-                            except ValueError:
-                                pass
-                        if 'Total_LBAs_Written' in text:
-                            val = val*LBA_size
-                        if 'Host_Writes_32MiB' in text:
-                            val = val*32*1024*1000
-                        if val > 99999:
-                            val = self.human_size(val)
-                        return val
-                    if 'Available Spare' in text:
-                        #SSD Spare capacity Available
-                        val = info[-1].replace("%","")
-                        return val
-                    if 'Percentage Used' in text:
-                        #SSD life remaining
-                        val =  str(100 - int(info[-1].replace("%","")))
-                        return val
-                    if 'Data Units Written' in text:
-                        val = info[-2]+' '+info[-1]
-                        return val.replace('[','').replace(']','')
-                    elif 'write:' in text:
-                        val = self.human_size(float(info[-2])*1000000000)
-                        return val
-                    if '(hours)' in text:
-                        #power on hours is on the next line
-                        if 'in progress' in lines[line_num+1]:
-                            return 'pending'
-                        line_text = lines[line_num+1].split()
-                        for column, data in enumerate(line_text):
-                            if data.isdigit() and column > 2: #skip test number
-                                val=data
-                                return val
-                    for count, data in enumerate(info):
-                        data = data.replace('%','').replace(',','')
-                        if data.isdigit() and count > 0:
-                            val = int(data)
-                            return val
-        return val
-                          
-    def SCSI_disk_info(self):
-        self.num_drives = 1
-        now = dt.datetime.now()
-        if now.hour == 0 and now.minute == 0:   #run short drive test at midnight
-            log.info('running self test')
-            cmd_string = 'smartctl %s -t short %s' % (self.drive_db,self.name)
-        else:
-            cmd_string = 'smartctl %s -a %s' % (self.drive_db,self.name)
+    def raid_drives(self):
+        if self.drive.get("logical_volumes"):
+            return self.drive["logical_volumes"][0]["drives"]
+        return []
+        
+    def setup_raid_lists(self):
+        self.records = [drive_record(self.name, drive_no) for drive_no in range(len(self.raid_drives()))]
+        log.debug('number of drives in raid %s: %s' % (self.name, self.num_drives))
+            
+    def smart_commands(self, option=None):
+        '''
+        returns a list of (drive_no, smartctl command) to run for this drive
+        drive_no is None for a plain disk, or the index of the physical drive in a RAID volume
+        option is the smartctl option to use (eg '-H'), default is to read all the SMART data
+        '''
+        if option is None:
+            now = dt.datetime.now()
+            if self.selftest and now.hour == 0 and now.minute == 0:   #run short drive test at midnight
+                log.info('running self test')
+                option = '-t short'
+            elif self.use_json:
+                option = '-j -a'
+            else:
+                option = '-a'
+        if not self.raid:
+            return [(None, 'smartctl %s %s %s' % (self.drive_db, option, self.name))]
+        commands = []
+        for drive_no, physicaldrive in enumerate(self.raid_drives()):
+            #config.ini files saved before the RAID backends only have ssacli drives, read with -d cciss,N
+            smart_device = physicaldrive.get('smart_device', 'cciss,%d' % (int(physicaldrive["physicaldrive"].split(':')[-1]) -1))
+            if smart_device is None:
+                continue    #the controller has no way to pass SMART commands to this drive
+            commands.append((drive_no, 'smartctl %s %s %s -d %s' % (self.drive_db, option, self.name, smart_device)))
+        return commands
+        
+    def get_smart_output(self, cmd_string):
+        '''
+        returns the SMART data for cmd_string, as smartctl output lines, or a smart_record if it was read directly
+        SMART reads of NVMe drives use the NVMe admin ioctl if they can, rather than starting smartctl
+        '''
+        if nvme_ioctl and self.drive['type'] == 'NVME SSD' and '-t ' not in cmd_string:
+            try:
+                return parse_nvme_smart_log(get_runner().read_log_page(self.name, NVME_LOG_SMART), self.drive['ssd'])
+            except (OSError, ValueError) as e:
+                log.debug('could not read NVMe SMART log of %s, using smartctl: %s' % (self.name, e))
+        return self.get_smart_text(cmd_string)
+        
+    def get_smart_text(self, cmd_string):
         try:
-            smart_text = check_output(cmd_string.split())
+            smart_text = run_command(cmd_string, device_timeout)
         except CalledProcessError as e:
             smart_text = e.output
+        except TimeoutExpired:
+            log.warning('no SMART data for %s, smartctl timed out' % self.name)
+            return smart_record(smart_status=SMART_TIMEOUT)
         lines = smart_text.decode('utf8').split('\n')
         log.debug('SMART: %s' % lines)
-        self.temp = self.get_data_from_text('Temperature', lines)
-        self.bytes_written = self.get_data_from_text(['Total_LBAs_Written', 'Data Units Written', 'write:', 'Host_Writes_32MiB'], lines)
-        self.smart_status = self.get_data_from_text(['SMART Health Status', 'SMART overall-health'], lines)
-        self.power_on_hrs = self.get_data_from_text(['Power_On_Hours', 'Power On Hours'], lines)
-        if self.drive['ssd']:
-            self.ssd = True
-            self.life = self.get_data_from_text(['Percentage Used','Wear_Leveling_Count', 'Remaining_Lifetime_Perc'], lines)
-            self.spare = self.get_data_from_text(['Available Spare', 'Available_Reservd_Space'], lines)
+        return lines
         
-    def RAID_disk_info(self):
-        physicaldrives = self.drive["logical_volumes"][0]["drives"]
-        self.num_drives = len(physicaldrives)
-        log.debug('number of drives in raid %s: %s' % (self.name, self.num_drives))
-        if self.num_drives > 0:
-            self.temp = []
-            self.life = []
-            self.spare = []
-            self.bytes_written = []
-            self.power_on_hrs = []
-            self.smart_status = []
-            self.ssd = []
-        log.debug('RAID drives: %s' % self.drive["logical_volumes"][0]["drives"])
-        for physicaldrive in physicaldrives:
-            drive_num = int(physicaldrive["physicaldrive"].split(':')[-1]) -1
-            #log.info('getting data for %s(%d)' % (self.name,drive_num ))
-            now = dt.datetime.now()
-            if now.hour == 0 and now.minute == 0:   #run short drive test at midnight
-                log.info('running self test')
-                cmd_string = 'smartctl %s -t short %s -d cciss,%s' % (self.drive_db, self.name, drive_num)
-            else:
-                cmd_string = 'smartctl %s -a %s -d cciss,%s' % (self.drive_db, self.name, drive_num)
+    def update_health(self, lines, drive_no=None):
+        '''
+        update just the SMART health status from smartctl -H output (or a smart_record)
+        '''
+        if isinstance(lines, smart_record):
+            self.record(drive_no).smart_status = lines.smart_status
+            return
+        self.record(drive_no).smart_status = SMART_PARSER.parse_values(lines, ['smart_status'])['smart_status']
+            
+    def update_from_output(self, lines, drive_no=None):
+        '''
+        update the SMART values from smartctl output, which can be JSON (smartctl -j) or text, or a smart_record
+        '''
+        if isinstance(lines, smart_record):
+            self.update_from_record(lines, drive_no)
+            return
+        if self.use_json and len(lines) > 0 and lines[0].startswith('{'):
             try:
-                smart_text = check_output(cmd_string.split())
-            except CalledProcessError as e:
-                smart_text = e.output
-            lines = smart_text.decode('utf8').split('\n')
-            log.debug('SMART: %s' % lines)
-            self.temp.append(self.get_data_from_text('Temperature', lines))
-            self.bytes_written.append(self.get_data_from_text(['Total_LBAs_Written', 'Data Units Written', 'write:', 'Host_Writes_32MiB'], lines))
-            self.smart_status.append(self.get_data_from_text(['SMART Health Status', 'SMART overall-health'], lines))
-            self.power_on_hrs.append(self.get_data_from_text(['Power_On_Hours', 'Power On Hours', '(hours)'], lines))
-            if self.drive['ssd']:
-                self.ssd.append(True)
-                self.life.append(self.get_data_from_text(['Percentage Used','Wear_Leveling_Count', 'Remaining_Lifetime_Perc'], lines))
-                self.spare.append(self.get_data_from_text(['Available Spare', 'Available_Reservd_Space'], lines))
+                data = json.loads('\n'.join(lines))
+            except ValueError as e:
+                log.warning('could not decode smartctl JSON output for %s, using text: %s' % (self.name, e))
             else:
-                self.ssd.append(False)
-                
+                self.update_from_record(SMART_JSON_PARSER.parse(data, self.drive['ssd']), drive_no)
+                return
+        self.update_from_text(lines, drive_no)
+        
+    def update_from_text(self, lines, drive_no=None):
+        '''
+        update the SMART values from smartctl text output, drive_no is the index of the physical drive for RAID volumes
+        '''
+        if drive_no is None:
+            self.update_from_record(SMART_PARSER.parse(lines, self.drive['ssd']))
+        else:
+            self.update_from_record(RAID_SMART_PARSER.parse(lines, self.drive['ssd']), drive_no)
+            
+    def update_from_record(self, record, drive_no=None):
+        self.record(drive_no).update(record, self.drive['ssd'])
+                          
+    def SCSI_disk_info(self):
+        for drive_no, cmd_string in self.smart_commands():
+            self.update_from_output(self.get_smart_output(cmd_string), drive_no)
+        
+    def RAID_disk_info(self):
+        log.debug('RAID drives: %s' % self.raid_drives())
+        for drive_no, cmd_string in self.smart_commands():
+            #log.info('getting data for %s(%d)' % (self.name,drive_no ))
+            self.update_from_output(self.get_smart_output(cmd_string), drive_no)
  
         
 NOT_WHITESPACE = re.compile(r'[^\s]')
@@ -226,60 +1278,63 @@ def decode_stacked(document, pos=0, decoder=JSONDecoder()):
         yield obj
     
 def get_drives(config_file = 'config.ini'):
+    '''
+    find all the drives, and save the drive map in config_file
+    if lsblk or lshw time out, the drives saved in config_file are used, or failing that the drives in sysfs
+    '''
     log.info('rescanning drives, please wait ...')
+    if discovery == 'sysfs' and list_block_devices():
+        drives = sysfs_drives(get_raid_snapshot())
+    else:
+        try:
+            drives = lshw_drives()
+        except TimeoutExpired as e:
+            if os.path.isfile(config_file):
+                log.warning('%s, using the drives saved in %s' % (e, config_file))
+                return load_drives(config_file)
+            if not can_read_sysfs():
+                raise
+            log.warning('%s, finding the drives from sysfs' % e)
+            drives = sysfs_drives(get_raid_snapshot())
+                
+    check_smart_support(drives, drives.keys())
+    for drive in drives.values():
+        #the RAID volume may not support SMART itself, but the physical drives can be read through the controller
+        if any(pd.get('smart_device') for lv in drive.get('logical_volumes', []) for pd in lv['drives']):
+            drive['SMART'] = True
+    add_fingerprints(drives, get_raid_snapshot().fingerprints())
+            
+    log.debug('got drive info: %s' % json.dumps(drives, indent=2))
+    
+    save_drives(drives, config_file)
+        
+    return drives
+    
+def lshw_drives():
+    '''
+    returns the drive map (before check_smart_support) from lsblk and lshw
+    '''
     drives = {}
-    drives_1 = json.loads(check_output('lsblk -J'.split()).decode('utf-8'))
-    drives_2_raw = check_output('lshw -C storage -C disk -json'.split()).decode('utf8').replace('\n','').strip()
+    #these don't depend on each other, so run them all at the same time
+    raid = raid_commands() if raid_data is None else []
+    results = run_commands(['lsblk -J', 'lshw -C storage -C disk -json'] + raid)
+    drives_1, drives_2_raw = results[:2]
+    snapshot = get_raid_snapshot(results=dict(zip(raid, results[2:])) if raid_data is None else None)
+    drives_1 = json.loads(raise_error(drives_1).decode('utf-8'))
+    drives_2_raw = raise_error(drives_2_raw).decode('utf8').replace('\n','').strip()
     drives_2 = []
     for obj in decode_stacked(drives_2_raw):
         drives_2.append(obj)      
     log.debug('got drives_2 data: \n%s' % json.dumps(drives_2, indent=2))
-    try:
-        drives_3 = check_output('ssacli ctrl all show status'.split()).decode('utf8')
-        log.debug('got drives_3 data: \n%s' % drives_3)
-    except CalledProcessError:
-        drives_3 = ''
-    
-    controllers = []
-    for line in drives_3.split('\n'):
-        if 'slot' in line.lower():
-            words = line.split()
-            for word in words:
-                if word.isdigit():
-                    controllers.append(int(word))
-                    log.info("found: %s, adding controller: %s" % (line, word))
-                    
-    for controller in controllers:
-        cmd_string = 'ssacli ctrl slot=%s show config' % controller
-        drives_4 = check_output(cmd_string.split()).decode('utf8')
-        log.debug('got drives_4 data: \n%s' % drives_4)
     
+    for controller in snapshot.controllers:
+        log.info("found: %s in Slot %s, adding controller: %s" % (controller['name'], controller['slot'], controller['slot']))
     
     for drive in drives_1["blockdevices"]:
         if 'loop' not in drive['type']:
-            drive_name = '/dev/' + drive['name']
-            drives[drive_name] = {}
-            drives[drive_name]['size'] = drive['size']
-            if 'nvme' in drive['name'].lower():
-                drives[drive_name]['SMART'] = True  #assume nvme drives report SMART data
-                drives[drive_name]['type'] = 'NVME SSD'
-                drives[drive_name]['ssd'] = True
-            else:
-                drives[drive_name]['SMART'] = False
-                drives[drive_name]['ssd'] = False
-                drives[drive_name]['type'] = drive['type']
-            if 'children' in drive.keys():  #no children for NVME drives, they are their own controller.
-                drives[drive_name]['mountpoints'] = []
-                for mountpoint in drive['children']:
-                    if mountpoint["mountpoint"] != None:
-                        drives[drive_name]['mountpoints'].append(mountpoint["mountpoint"] + "(" + mountpoint["size"] + ")")
-    
-    raid_controller_id = len(controllers)-1
-    increment_controller = False
+            drives['/dev/' + drive['name']] = block_device_entry(drive)
+    
     for controller in drives_2:
-        if increment_controller:
-            raid_controller_id=max(raid_controller_id-1,0)
-            increment_controller = False
         if controller.get('children'):
             for drive in controller['children']:
                 drive_name = drive["logicalname"]
@@ -290,85 +1345,332 @@ def get_drives(config_file = 'config.ini'):
                 drives[drive_name]['type'] = drive['description'] + " " + drive['product']
                 if 'raid' in controller.get("description", "none").lower():
                     drives[drive_name]['type'] = 'RAID ' + drives[drive_name]['type']
-                    if len(controllers) > 0:
-                        controller["physid"] = controllers[raid_controller_id]
-                        increment_controller = True
-                    drives[drive_name]["controller_physid"] = controller["physid"]
-                    drives[drive_name]['logical_volumes'] = []
-                    
-                    cmd_string = 'ssacli ctrl slot=%s ld all show status' % controller["physid"]
-                    l_volumes = check_output(cmd_string.split())
-                    lines = l_volumes.decode('utf8').split('\n')
-                    l_volume_devs = {}
-                    
-                    for line in lines:
-                        if len(line) > 0:
-                            info = line.split()
-                            if 'logicaldrive' in info[0]:
-                                lv_num = info[1].strip()
-                                cmd_string = 'ssacli ctrl slot=%s ld %s show' % (controller["physid"], lv_num)
-                                l_volume_info = check_output(cmd_string.split())
-                                info_lines = l_volume_info.decode('utf8').split('\n')
-                                l_volume_devs[lv_num] = 'unknown'
-                                for info_line in info_lines:
-                                    if len(info_lines) > 0:
-                                        disk_info = info_line.split(':')
-                                        if 'Disk Name' in disk_info[0]:
-                                            l_volume_devs[lv_num] = disk_info[1].strip()
-                                            break
-                    
-                    cmd_string = 'ssacli ctrl slot=%s show config' % controller["physid"]
-                    l_volumes = check_output(cmd_string.split())
-                    lines = l_volumes.decode('utf8').split('\n')
-                    
-                    for line in lines:
-                        if len(line) > 0:
-                            info = line.split()
-                            if len(info) > 1:
-                                if 'logicaldrive' in info[0]:
-                                    lv = {}
-                                    lv['logicaldrive'] = info[1].strip()
-                                    lv['size'] = info[2].replace('(','').strip() + " " + info[3].replace(',','').strip()
-                                    lv['raid'] = info[5].replace('):','').strip()
-                                    lv['status'] = info[-1].replace(')','').strip()
-                                    lv['drives'] = []
-                                    if drive_name == l_volume_devs[lv['logicaldrive']]:
-                                        log.info('adding logical volume %s to drive %s' % (lv['logicaldrive'], drive_name))
-                                        drives[drive_name]['logical_volumes'].append(lv)
-
-                                if 'physicaldrive' in info[0] and drive_name == l_volume_devs[lv['logicaldrive']]:
-                                    pd = {}
-                                    pd['physicaldrive'] = info[1].strip()
-                                    pd['type'] = info[6].strip() + " " + info[7].replace(',','').strip()
-                                    pd['ssd'] = True if 'ssd' in info[7].lower() else False
-                                    pd['size'] = info[8].strip() + " " + info[9].replace(',','').strip()
-                                    if 'OK' in info[-1].replace(')','').strip():
-                                        pd['status'] = info[-1].replace(')','').strip()
-                                    else:
-                                        pd['status'] = info[-2].replace(',','').strip() + " " + info[-1].replace(')','').strip()
-                                    lv['drives'].append(pd)
-
-    #log.info('drives: \n%s' % json.dumps(drives, indent=2))
-                
-    for drive in drives.copy().keys():
-        cmd_string = 'smartctl -i %s' % drive
+                    slot, logical_volumes = snapshot.find_disk(drive_name)
+                    drives[drive_name]["controller_physid"] = controller["physid"] if slot is None else int(slot) if slot.isdigit() else slot
+                    drives[drive_name]['logical_volumes'] = logical_volumes
+                    for lv in logical_volumes:
+                        log.info('adding logical volume %s to drive %s' % (lv['logicaldrive'], drive_name))
+    return drives
+    
+def sysfs_drives(snapshot, sysfs=None):
+    '''
+    returns the drive map (before check_smart_support) from sysfs, the same as lshw_drives gives, without running lsblk or lshw
+    RAID volumes are the disks on a RAID controller (PCI class 0x0104), or HP logical volumes
+    '''
+    drives = {}
+    for controller in snapshot.controllers:
+        log.info("found: %s in Slot %s, adding controller: %s" % (controller['name'], controller['slot'], controller['slot']))
+    mounts = get_mounts()
+    swaps = get_swaps()
+    for drive_name in list_block_devices(sysfs):
+        drives[drive_name] = block_device_entry(sysfs_block_device(drive_name, mounts, swaps, sysfs))
+        drive_type = sysfs_type(drive_name, sysfs)
+        if drives[drive_name]['type'] == 'NVME SSD' or drive_type is None:
+            continue
+        drives[drive_name]['type'] = drive_type
+        drives[drive_name]['ssd'] = read_sysfs(os.path.join(sysfs or SYSFS, 'block', os.path.basename(drive_name), 'queue/rotational')) == '0'
+        pci_address, pci_class = storage_controller(drive_name, sysfs)
+        if pci_class == PCI_CLASS_RAID or is_raid_volume(drive_name, sysfs):
+            drives[drive_name]['type'] = 'RAID ' + drive_type
+            drives[drive_name]['ssd'] = False
+            slot, logical_volumes = snapshot.find_disk(drive_name)
+            drives[drive_name]["controller_physid"] = (pci_address or '0') if slot is None else int(slot) if slot.isdigit() else slot
+            drives[drive_name]['logical_volumes'] = logical_volumes
+            for lv in logical_volumes:
+                log.info('adding logical volume %s to drive %s' % (lv['logicaldrive'], drive_name))
+    return drives
+    
+def block_device_entry(drive):
+    '''
+    returns the drive map entry for a block device from lsblk -J (or sysfs_block_device)
+    '''
+    entry = {}
+    entry['size'] = drive['size']
+    if 'nvme' in drive['name'].lower():
+        entry['SMART'] = True  #assume nvme drives report SMART data
+        entry['type'] = 'NVME SSD'
+        entry['ssd'] = True
+    else:
+        entry['SMART'] = False
+        entry['ssd'] = False
+        entry['type'] = drive['type']
+    if 'children' in drive.keys():  #no children for NVME drives, they are their own controller.
+        entry['mountpoints'] = []
+        for mountpoint in drive['children']:
+            if mountpoint["mountpoint"] != None:
+                entry['mountpoints'].append(mountpoint["mountpoint"] + "(" + mountpoint["size"] + ")")
+    return entry
+    
+def check_smart_support(drives, names):
+    '''
+    run smartctl -i on drives names, to see if they support SMART and are SSD's
+    a drive that doesn't answer in time is kept as a SMART drive (so it's reported as unknown/timeout, rather than left out),
+    and marked with probe_timeout so the drive map isn't saved with it's guessed details
+    '''
+    names = list(names)
+    smart_info = run_commands(['smartctl -i %s' % drive for drive in names])
+    for drive, drives_3 in zip(names, smart_info):
         try:
-            drives_3 = check_output(cmd_string.split())
-            for line in drives_3.decode('utf8').split('\n'):
+            for line in raise_error(drives_3).decode('utf8').split('\n'):
                 if 'SMART support is:' in line and 'Enabled' in line:
                     log.debug('set drive %s to SMART: True' % drive)
                     drives[drive]['SMART'] = True
                 if 'solid state device' in line.lower() or 'ssd' in line.lower():
                     drives[drive]['ssd'] = True
+                if line.lower().startswith('serial number:'):
+                    drives[drive]['serial'] = line.split(':', 1)[1].strip()
+        except TimeoutExpired:
+            log.warning('checking SMART status in drive %s timed out' % drive)
+            drives[drive]['SMART'] = True
+            drives[drive]['probe_timeout'] = True
         except CalledProcessError:
             log.warning('error checking SMART status in drive %s' % drive)
             pass
             
-    log.debug('got drive info: %s' % json.dumps(drives, indent=2))
-    
+def save_drives(drives, config_file = 'config.ini'):
+    timed_out = [name for name, drive in drives.items() if drive.get('probe_timeout')]
+    if timed_out:
+        log.warning('not saving %s, probing %s timed out' % (config_file, ', '.join(timed_out)))
+        return
     with open(config_file, 'w') as f:
         f.write(json.dumps(drives, indent=2))
         
+SYSFS = '/sys'
+PROC_MOUNTS = '/proc/self/mounts'
+PROC_SWAPS = '/proc/swaps'
+PCI_CLASS_RAID = '0x0104'
+#block devices that lsblk doesn't list at the top level (or that we ignore)
+IGNORE_BLOCK_DEVICES = ('loop', 'ram', 'dm-', 'md')
+        
+def read_sysfs(path, default=''):
+    try:
+        with open(path, 'rb') as f:
+            return f.read().decode('utf8', 'replace').strip()
+    except OSError:
+        return default
+        
+def get_mounts(proc_mounts=None):
+    '''
+    returns a dict of device name (eg sda1): list of mountpoints
+    '''
+    mounts = {}
+    try:
+        with open(proc_mounts or PROC_MOUNTS, 'r') as f:
+            for line in f:
+                info = line.split()
+                if len(info) > 1 and info[0].startswith('/dev/'):
+                    mounts.setdefault(os.path.basename(info[0]), []).append(info[1])
+    except OSError:
+        pass
+    return mounts
+        
+def get_swaps(proc_swaps=None):
+    '''
+    returns a set of the names of the devices (eg sda3) used for swap
+    '''
+    try:
+        with open(proc_swaps or PROC_SWAPS, 'r') as f:
+            return set(os.path.basename(line.split()[0]) for line in f if line.startswith('/dev/'))
+    except OSError:
+        return set()
+        
+def lsblk_size(size_bytes):
+    '''
+    format a size in bytes the same way lsblk does, powers of 1024 with at most one decimal place, e.g. 512M, 465.8G, 1.6T
+    '''
+    exp = 0
+    while exp < 60 and size_bytes >= 1 << (exp + 10):
+        exp += 10
+    whole, frac = divmod(size_bytes, 1 << exp)
+    if frac:
+        frac = (frac * 1000 // (1 << exp) + 50) // 100
+        if frac == 10:
+            whole += 1
+            frac = 0
+    suffix = 'BKMGTPE'[exp // 10]
+    return '%d.%d%s' % (whole, frac, suffix) if frac else '%d%s' % (whole, suffix)
+    
+def sysfs_block_device(name, mounts=None, swaps=None, sysfs=None):
+    '''
+    returns block device name from sysfs, in the same form as an lsblk -J blockdevice, with the partitions as children
+    '''
+    if mounts is None:
+        mounts = get_mounts()
+    if swaps is None:
+        swaps = get_swaps()
+    dev = os.path.basename(name)
+    path = os.path.join(sysfs or SYSFS, 'block', dev)
+    
+    def size(path):
+        return lsblk_size(int(read_sysfs(os.path.join(path, 'size'), '0') or 0) * 512)  #always in 512 byte sectors
+        
+    drive = {'name': dev, 'size': size(path), 'type': 'rom' if read_sysfs(os.path.join(path, 'device/type')) == '5' else 'disk'}
+    try:
+        partitions = sorted(part for part in os.listdir(path) if part.startswith(dev))
+    except OSError:
+        partitions = []
+    if partitions:
+        drive['children'] = [{'name': part, 'size': size(os.path.join(path, part)), 'type': 'part',
+                              'mountpoint': '[SWAP]' if part in swaps else mounts.get(part, [None])[0]} for part in partitions]
+    return drive
+    
+def storage_controller(name, sysfs=None):
+    '''
+    returns (PCI address, PCI class, eg 0x0104 for RAID) of the storage controller block device name is on, or (None, None)
+    found by going up the device's sysfs path to the first PCI mass storage device
+    '''
+    root = os.path.realpath(sysfs or SYSFS)
+    path = os.path.realpath(os.path.join(root, 'block', os.path.basename(name), 'device'))
+    while path.startswith(root + os.sep):
+        pci_class = read_sysfs(os.path.join(path, 'class'))
+        if pci_class.startswith('0x01'):
+            return os.path.basename(path), pci_class[:6]
+        path = os.path.dirname(path)
+    return None, None
+    
+def can_read_sysfs():
+    '''
+    returns True if the drives can be found from sysfs, which isn't the case when replaying another host's commands
+    '''
+    return bool(list_block_devices()) and not isinstance(get_runner(), replay_runner)
+    
+def list_block_devices(sysfs=None):
+    '''
+    returns the /dev names of the block devices in sysfs
+    '''
+    try:
+        names = os.listdir(os.path.join(sysfs or SYSFS, 'block'))
+    except OSError:
+        return []
+    return ['/dev/' + name for name in sorted(names) if not name.startswith(IGNORE_BLOCK_DEVICES)]
+    
+def device_fingerprint(name, mounts=None, sysfs=None):
+    '''
+    returns a hash of the things that identify block device name from sysfs - size, model, serial numbers, partitions and mountpoints
+    if any of them change, the drive needs probing again
+    '''
+    if mounts is None:
+        mounts = get_mounts()
+    dev = os.path.basename(name)
+    path = os.path.join(sysfs or SYSFS, 'block', dev)
+    values = [read_sysfs(os.path.join(path, item)) for item in ['size',
+                                                                'device/vendor',
+                                                                'device/model',
+                                                                'device/serial',
+                                                                'device/wwid',
+                                                                'wwid',
+                                                                'device/vpd_pg80',
+                                                                'queue/rotational']]
+    try:
+        partitions = sorted(part for part in os.listdir(path) if part.startswith(dev))
+    except OSError:
+        partitions = []
+    for part in partitions:
+        values += [part, read_sysfs(os.path.join(path, part, 'size')), ','.join(mounts.get(part, []))]
+    return hashlib.sha1('|'.join(values).encode('utf8')).hexdigest()[:16]
+    
+def is_raid_volume(name, sysfs=None):
+    '''
+    returns True if block device name is a RAID volume, an HP logical volume or a disk on a RAID controller
+    '''
+    if 'LOGICAL VOLUME' in read_sysfs(os.path.join(sysfs or SYSFS, 'block', os.path.basename(name), 'device/model')):
+        return True
+    return storage_controller(name, sysfs)[1] == PCI_CLASS_RAID
+    
+def sysfs_type(name, sysfs=None):
+    '''
+    returns the drive type (eg 'ATA Disk Samsung SSD 850') from sysfs, the same as lshw reports, or None
+    '''
+    path = os.path.join(sysfs or SYSFS, 'block', os.path.basename(name), 'device')
+    model = read_sysfs(os.path.join(path, 'model'))
+    if not model:
+        return None
+    vendor = read_sysfs(os.path.join(path, 'vendor'))
+    return '%s Disk %s' % ('ATA' if vendor == 'ATA' else 'SCSI', model)
+    
+def add_fingerprints(drives, controller_fps=None):
+    '''
+    add the device fingerprint to each drive, and the controller fingerprint to RAID drives if controller_fps is given
+    '''
+    mounts = get_mounts()
+    for name in drives.keys():
+        drives[name]['fingerprint'] = device_fingerprint(name, mounts)
+        if controller_fps is not None and 'controller_physid' in drives[name]:
+            drives[name]['controller_fingerprint'] = controller_fps.get(str(drives[name]['controller_physid']))
+            
+def rescan_drives(config_file = 'config.ini'):
+    '''
+    incremental rescan, compares the drives with the fingerprints saved in config_file, and only probes the drives that
+    have been added or changed. Unchanged drives keep their saved details.
+    Does a full rescan if there is no saved config, a RAID controller's configuration has changed, or a RAID volume has been added
+    '''
+    if not os.path.isfile(config_file):
+        return get_drives(config_file)
+    old_drives = load_drives(config_file)
+    if any('fingerprint' not in drive for drive in old_drives.values()):
+        log.info('no drive fingerprints saved, doing full rescan')
+        return get_drives(config_file)
+    log.info('checking for drive changes ...')
+    mounts = get_mounts()
+    current = {name : device_fingerprint(name, mounts) for name in list_block_devices()}
+    
+    controller_fps = {}
+    raid_drives = [name for name, drive in old_drives.items() if 'controller_physid' in drive]
+    if raid_drives:
+        controller_fps = get_raid_snapshot().fingerprints()
+    
+    removed = [name for name in old_drives if name not in current]
+    added = [name for name in current if name not in old_drives]
+    changed = [name for name in current if name in old_drives and old_drives[name]['fingerprint'] != current[name]]
+    
+    for name in raid_drives:
+        if old_drives[name].get('controller_fingerprint') != controller_fps.get(str(old_drives[name]['controller_physid'])):
+            log.info('RAID controller for %s has changed, doing full rescan' % name)
+            return get_drives(config_file)
+    for name in added:
+        if is_raid_volume(name):
+            log.info('RAID volume %s has been added, doing full rescan' % name)
+            return get_drives(config_file)
+            
+    for name in removed:
+        log.info('drive %s has been removed' % name)
+    drives = {name : drive for name, drive in old_drives.items() if name not in removed}
+    if added or changed:
+        log.info('probing new drives: %s, changed drives: %s' % (added, changed))
+        drives.update(probe_drives(added + changed, old_drives))
+    elif not removed:
+        log.info('no drive changes found')
+    save_drives(drives, config_file)
+    return drives
+    
+def probe_drives(names, old_drives={}):
+    '''
+    returns drive map entries for just the drives names, RAID volumes keep the RAID details from old_drives
+    '''
+    drives = {}
+    if discovery == 'sysfs':
+        mounts = get_mounts()
+        swaps = get_swaps()
+        blockdevices = [sysfs_block_device(name, mounts, swaps) for name in names]
+    else:
+        try:
+            blockdevices = json.loads(run_command('lsblk -J %s' % ' '.join(names)).decode('utf8'))["blockdevices"]
+        except TimeoutExpired as e:
+            if not can_read_sysfs():
+                raise
+            log.warning('%s, reading the drives from sysfs' % e)
+            blockdevices = [sysfs_block_device(name, get_mounts(), get_swaps()) for name in names]
+    for drive in blockdevices:
+        drive_name = '/dev/' + drive['name']
+        drives[drive_name] = block_device_entry(drive)
+        old_drive = old_drives.get(drive_name, {})
+        if 'controller_physid' in old_drive:
+            for key in ['type', 'SMART', 'ssd', 'controller_physid', 'controller_fingerprint', 'logical_volumes']:
+                drives[drive_name][key] = old_drive[key]
+        elif drives[drive_name]['type'] != 'NVME SSD':
+            drives[drive_name]['type'] = sysfs_type(drive_name) or drives[drive_name]['type']
+    check_smart_support(drives, [name for name in drives if 'controller_physid' not in drives[name]])
+    add_fingerprints(drives)
     return drives
         
 def load_drives(config_file = 'config.ini'):
@@ -376,92 +1678,558 @@ def load_drives(config_file = 'config.ini'):
         drives=json.loads(f.read())
     return drives
     
-def check_raid_failures(arg):
-    raid_info=''
-    special_strings=['failed', 'rebuilding', 'recovering']
-    cmd_string = 'ssacli ctrl all show config'
+def check_raid_failures(arg, refresh=False):
+    '''
+    returns the RAID logical and physical drives that have failed, or are rebuilding/recovering
+    uses the RAID configuration already read this run, unless refresh is True
+    '''
+    raid_info = get_raid_snapshot(refresh).raid_issues()
+    if not arg.summary:
+        if raid_info != '':            
+            log.info('RAID Problems: %s' % raid_info)
+        else:
+            log.info('RAID Status: OK')
+    return raid_info
+    
+class raid_snapshot():
+    '''
+    base class of the RAID backends, each one reads the configuration of all it's controllers (with one command, or a file),
+    parsed into controllers -> arrays -> logical drives and physical drives (plus unassigned physical drives)
+    each logical/physical drive is a dict of details named the way ssacli names them, eg 'Status', 'Size', 'Disk Name',
+    so the rest of the program doesn't need to know which backend they came from
+    '''
+    name = None
+    programs = []           #the backend's program, the first one installed is used
+    arguments = ''          #the arguments that show the whole configuration
+    special_strings = ['failed', 'rebuilding', 'recovering']
+    
+    def __init__(self, text=''):
+        self.controllers = []
+        self.timed_out = False  #the backend's command timed out, so the RAID status isn't known
+        self.parse(text)
+        
+    @classmethod
+    def command(cls):
+        '''
+        returns the command that reads the configuration, or None if the backend's program isn't installed
+        '''
+        program = get_runner().which(cls.programs)
+        return '%s %s' % (program, cls.arguments) if program else None
+        
+    @classmethod
+    def load(cls, results):
+        '''
+        returns the snapshot from results, a dict of command: output (or the exception raised)
+        '''
+        command = cls.command()
+        text = ''
+        timed_out = False
+        if command is not None:
+            try:
+                text = raise_error(results[command]).decode('utf8')
+                log.debug('got %s data: \n%s' % (cls.name, text))
+            except TimeoutExpired as e:
+                log.warning('no %s data: %s' % (cls.name, e))
+                timed_out = True
+            except (CalledProcessError, OSError) as e:
+                log.debug('no %s data: %s' % (cls.name, e))
+        snapshot = cls(text)
+        snapshot.timed_out = timed_out
+        return snapshot
+        
+    def parse(self, text):
+        pass
+        
+    def smart_device(self, pd):
+        '''
+        returns the smartctl device type (-d) that reads physical drive pd through the controller, or None if it can't be
+        '''
+        return None
+        
+    def location(self, pd):
+        return 'bay %s' % pd.get('Bay')
+        
+    def physical_drive(self, pd):
+        '''
+        returns a physical drive in the format saved in config.ini
+        '''
+        interface = pd.get('Interface Type', '')
+        ssd = 'solid state' in interface.lower()
+        return {'physicaldrive' : pd['physicaldrive'],
+                'type'          : ('%s %s' % (interface.replace('Solid State', '').strip(), 'SSD' if ssd else 'HDD')).strip(),
+                'ssd'           : ssd,
+                'size'          : pd.get('Size'),
+                'status'        : pd.get('Status'),
+                'serial'        : pd.get('Serial Number'),
+                'model'         : ' '.join(pd.get('Model', '').split()),
+                'bay'           : pd.get('Bay'),
+                'smart_device'  : self.smart_device(pd)}
+                
+    def logical_volume(self, ld, array):
+        '''
+        returns a logical drive (with the physical drives in it's array) in the format saved in config.ini
+        '''
+        return {'logicaldrive' : ld['logicaldrive'],
+                'size'         : ld.get('Size'),
+                'raid'         : ld.get('Fault Tolerance'),
+                'status'       : ld.get('Status'),
+                'drives'       : [self.physical_drive(pd) for pd in array['physical_drives']]}
+        
+    def find_disk(self, disk_name):
+        '''
+        returns (controller slot, [logical volumes]) for the logical drives that are disk_name (eg /dev/sdb), or (None, [])
+        '''
+        for controller in self.controllers:
+            logical_volumes = [self.logical_volume(ld, array) for array in controller['arrays']
+                                                              for ld in array['logical_drives'] if ld.get('Disk Name') == disk_name]
+            if logical_volumes:
+                return controller['slot'], logical_volumes
+        return None, []
+        
+    def raid_issues(self):
+        '''
+        returns a line for each logical or physical drive that has failed, or is rebuilding/recovering
+        '''
+        raid_info = '%s controllers (RAID status %s)\n' % (self.name, SMART_TIMEOUT) if self.timed_out else ''
+        for controller in self.controllers:
+            pds = controller['unassigned'][:]
+            for array in controller['arrays']:
+                for ld in array['logical_drives']:
+                    if any(check in ld.get('Status', '').lower() for check in self.special_strings):
+                        raid_info += 'logicaldrive %s (%s, RAID %s, %s)\n' % (ld['logicaldrive'], ld.get('Size'), ld.get('Fault Tolerance'), ld.get('Status'))
+                pds += array['physical_drives']
+            for pd in pds:
+                if any(check in pd.get('Status', '').lower() for check in self.special_strings):
+                    info = self.physical_drive(pd)
+                    raid_info += 'physicaldrive %s (%s, %s, %s, %s)\n' % (pd['physicaldrive'], self.location(pd), info['type'], info['size'], info['status'])
+        return raid_info
+        
+    def fingerprints(self):
+        '''
+        returns a dict of controller slot: hash of it's configuration (arrays, logical drives, and physical drive serial numbers)
+        status and temperatures are left out, so a drive failing or rebuilding doesn't count as a change
+        '''
+        fingerprints = {}
+        for controller in self.controllers:
+            config = []
+            for array in controller['arrays']:
+                config.append([array['name'],
+                               [[ld['logicaldrive'], ld.get('Size'), ld.get('Fault Tolerance'), ld.get('Disk Name')] for ld in array['logical_drives']],
+                               [[pd['physicaldrive'], pd.get('Size'), pd.get('Interface Type'), pd.get('Serial Number')] for pd in array['physical_drives']]])
+            config.append([[pd['physicaldrive'], pd.get('Serial Number')] for pd in controller['unassigned']])
+            fingerprints[controller['slot']] = hashlib.sha1(json.dumps(config).encode('utf8')).hexdigest()[:16]
+        return fingerprints
+        
+class ssacli_snapshot(raid_snapshot):
+    '''
+    the HP Smart Array configuration from one 'ssacli ctrl all show config detail'
+    physical drives are read with smartctl -d cciss,N (N is the bay - 1)
+    '''
+    name = 'ssacli'
+    programs = ['ssacli']
+    arguments = 'ctrl all show config detail'
+    
+    def parse(self, text):
+        controller = array = item = None
+        section = None
+        child_indent = None     #the indent of the logical and physical drives in the section
+        for line in text.split('\n'):
+            stripped = line.strip()
+            if not stripped:
+                continue
+            indent = len(line) - len(line.lstrip())
+            if indent == 0:
+                match = re.search(r'(.*) in Slot (\w+)', stripped)
+                controller = None
+                if match:
+                    controller = {'slot': match.group(2), 'name': match.group(1).strip(), 'details': {}, 'arrays': [], 'unassigned': []}
+                    self.controllers.append(controller)
+                    section = 'controller'
+                continue
+            if controller is None:
+                continue
+            if indent <= 3:
+                #controller details, or the start of a new section
+                item = None
+                child_indent = None
+                if stripped.startswith('Array'):
+                    #'Array: A' in detail output, 'Array A (SAS, Unused Space: 0  MB)' otherwise
+                    array = {'name': stripped.replace(':',' ').split()[1], 'details': {}, 'logical_drives': [], 'physical_drives': []}
+                    controller['arrays'].append(array)
+                    section = 'array'
+                    item = array['details']
+                elif stripped.lower() == 'unassigned':
+                    section = 'unassigned'
+                elif section == 'controller' and ':' in stripped:
+                    key, value = stripped.split(':', 1)
+                    controller['details'][key.strip()] = value.strip()
+                else:
+                    section = None
+                continue
+            if section not in ['array', 'unassigned']:
+                continue
+            if child_indent is None:
+                child_indent = indent
+            if indent > child_indent and (stripped.startswith('physicaldrive') or re.match(r'(Mirror|Parity) Group', stripped)):
+                #a RAID 1/1+0 logical drive lists it's members again in 'Mirror Group N:', they are already in the array
+                continue
+            if indent == child_indent and stripped.startswith('Logical Drive:') and section == 'array':
+                item = {'logicaldrive': stripped.split(':', 1)[1].strip()}
+                array['logical_drives'].append(item)
+            elif indent == child_indent and stripped.startswith('logicaldrive') and section == 'array':
+                item = {'logicaldrive': stripped.split()[1]}
+                array['logical_drives'].append(item)
+            elif indent == child_indent and stripped.startswith('physicaldrive'):
+                item = {'physicaldrive': stripped.split()[1]}
+                if section == 'array':
+                    array['physical_drives'].append(item)
+                else:
+                    controller['unassigned'].append(item)
+            elif ':' in stripped and item is not None:
+                key, value = stripped.split(':', 1)
+                item.setdefault(key.strip(), value.strip())
+                
+    def smart_device(self, pd):
+        return 'cciss,%d' % (int(pd['physicaldrive'].split(':')[-1]) - 1)
+        
+    def location(self, pd):
+        return 'port %s:box %s:bay %s' % (pd.get('Port'), pd.get('Box'), pd.get('Bay'))
+        
+#storcli/perccli states, as the status ssacli would give
+STORCLI_VD_STATES = {'Optl' : 'OK',
+                     'Dgrd' : 'Degraded (failed drive)',
+                     'Pdgd' : 'Partially Degraded (failed drive)',
+                     'OfLn' : 'Failed (offline)',
+                     'Rec'  : 'Recovering',
+                     'Cac'  : 'OK'}
+STORCLI_PD_STATES = {'Onln'   : 'OK',
+                     'UGood'  : 'OK',
+                     'GHS'    : 'OK',
+                     'DHS'    : 'OK',
+                     'JBOD'   : 'OK',
+                     'Offln'  : 'Failed (offline)',
+                     'UBad'   : 'Failed (unconfigured bad)',
+                     'Failed' : 'Failed',
+                     'Rbld'   : 'Rebuilding',
+                     'Cpybck' : 'Rebuilding (copyback)',
+                     'Msng'   : 'Failed (missing)'}
+                     
+class storcli_snapshot(raid_snapshot):
+    '''
+    the LSI/Broadcom MegaRAID (and Dell PERC) configuration from one 'storcli /call show all J'
+    controller slots are c0, c1 etc. (as storcli names them), the drive groups are the arrays, and the virtual drives
+    are matched to their disks by SCSI address (the controller exposes virtual drive N as target N on channel 2)
+    physical drives are read with smartctl -d megaraid,N (or -d sat+megaraid,N for SATA drives), N is the device id
+    '''
+    name = 'storcli'
+    programs = ['storcli64', 'storcli', 'perccli64', 'perccli']
+    arguments = '/call show all J'
+    
+    def __init__(self, text='', sysfs=None):
+        self.sysfs = sysfs
+        super().__init__(text)
+        
+    def parse(self, text):
+        if not text.strip():
+            return
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            log.warning('could not decode storcli JSON output: %s' % e)
+            return
+        disks = megaraid_disks(self.sysfs)
+        for response in data.get('Controllers', []):
+            status = response.get('Command Status', {})
+            info = response.get('Response Data', {})
+            if status.get('Status') != 'Success' or not info:
+                log.debug('no storcli data for controller %s: %s' % (status.get('Controller'), status.get('Description')))
+                continue
+            basics = info.get('Basics', {})
+            number = basics.get('Controller', status.get('Controller'))
+            controller = {'slot': 'c%s' % number, 'name': basics.get('Model', 'MegaRAID'), 'details': basics, 'arrays': [], 'unassigned': []}
+            controller_disks = disks.get(pci_address(basics.get('PCI Address', '')), {}) if len(disks) > 1 else next(iter(disks.values()), {})
+            arrays = {}
+            for vd in info.get('VD LIST', []):
+                dg, number = vd.get('DG/VD', '-/-').split('/')
+                ld = {'logicaldrive'    : number,
+                      'Size'            : vd.get('Size'),
+                      'Fault Tolerance' : vd.get('TYPE', '').replace('RAID', ''),
+                      'Status'          : STORCLI_VD_STATES.get(vd.get('State'), vd.get('State')),
+                      'Disk Name'       : controller_disks.get(int(number)) if number.isdigit() else None}
+                arrays.setdefault(dg, {'name': dg, 'details': {}, 'logical_drives': [], 'physical_drives': []})['logical_drives'].append(ld)
+            for pd in info.get('PD LIST', []):
+                enclosure, bay = pd.get('EID:Slt', ':').split(':')
+                item = {'physicaldrive'  : pd.get('EID:Slt'),
+                        'Device Id'      : pd.get('DID'),
+                        'Interface Type' : '%s%s' % ('Solid State ' if pd.get('Med') == 'SSD' else '', pd.get('Intf', '')),
+                        'Size'           : pd.get('Size'),
+                        'Status'         : STORCLI_PD_STATES.get(pd.get('State'), pd.get('State')),
+                        'Model'          : pd.get('Model', ''),
+                        'Box'            : enclosure.strip(),
+                        'Bay'            : bay}
+                dg = str(pd.get('DG', '-'))
+                if dg in arrays:
+                    arrays[dg]['physical_drives'].append(item)
+                else:
+                    controller['unassigned'].append(item)
+            controller['arrays'] = [arrays[dg] for dg in sorted(arrays)]
+            self.controllers.append(controller)
+            
+    def smart_device(self, pd):
+        if pd.get('Device Id') is None:
+            return None
+        return '%smegaraid,%s' % ('sat+' if 'SATA' in pd.get('Interface Type', '') else '', pd['Device Id'])
+        
+    def location(self, pd):
+        return 'enclosure %s:slot %s' % (pd.get('Box'), pd.get('Bay'))
+        
+def pci_address(address):
+    '''
+    returns a PCI address as sysfs has it (eg 0000:03:00.0) from storcli's 'PCI Address' (eg 00:03:00:00)
+    '''
     try:
-        l_volumes = check_output(cmd_string.split())
-        lines = l_volumes.decode('utf8').split('\n')
+        domain, bus, device, function = [int(part, 16) for part in address.split(':')]
+    except ValueError:
+        return None
+    return '%04x:%02x:%02x.%x' % (domain, bus, device, function)
+    
+def megaraid_disks(sysfs=None):
+    '''
+    returns {PCI address: {virtual drive number: disk name}} for the disks on MegaRAID controllers, from their SCSI address
+    virtual drives are on channel 2 onwards, 128 to a channel
+    '''
+    disks = {}
+    for name in list_block_devices(sysfs):
+        address, pci_class = storage_controller(name, sysfs)
+        if pci_class != PCI_CLASS_RAID:
+            continue
+        scsi = os.path.basename(os.path.realpath(os.path.join(sysfs or SYSFS, 'block', os.path.basename(name), 'device'))).split(':')
+        if len(scsi) == 4 and scsi[1].isdigit() and scsi[2].isdigit() and int(scsi[1]) >= 2:
+            disks.setdefault(address, {})[(int(scsi[1]) - 2) * 128 + int(scsi[2])] = name
+    return disks
+    
+PROC_MDSTAT = '/proc/mdstat'
+
+class mdstat_snapshot(raid_snapshot):
+    '''
+    the Linux software RAID (md) arrays from /proc/mdstat, all on one controller (slot md), each array has one logical drive
+    the members are partitions or disks that are in the drive map themselves, so they are read without a -d device type
+    '''
+    name = 'mdstat'
+    special_strings = ['failed', 'degraded', 'recovering', 'rebuilding']
+    
+    @classmethod
+    def command(cls):
+        return None
         
-        for line in lines:
-            if len(line) > 0:
-                info = line.split()
-                if any(check.lower() in info[-1].replace(')','').replace(',','').lower() for check in special_strings):
-                    raid_info+= line.strip() + '\n'
-                if any(check.lower() in info[-3].replace(')','').replace(',','').lower() for check in special_strings):
-                    raid_info+= line.strip() + '\n'
-        if not arg.summary:
-            if raid_info != '':            
-                log.info('RAID Problems: %s' % raid_info)
+    @classmethod
+    def load(cls, results):
+        text = read_sysfs(PROC_MDSTAT)
+        log.debug('got mdstat data: \n%s' % text)
+        return cls(text)
+        
+    def parse(self, text):
+        controller = {'slot': 'md', 'name': 'Linux software RAID', 'details': {}, 'arrays': [], 'unassigned': []}
+        ld = None
+        for line in text.split('\n'):
+            match = re.match(r'(md\w+)\s*:\s*(\w+)\s+(.*)', line)
+            if match:
+                name, state, rest = match.groups()
+                fields = [field for field in rest.split() if not field.startswith('(')]     #eg (auto-read-only)
+                level = fields[0] if fields and '[' not in fields[0] else ''
+                ld = {'logicaldrive'    : name,
+                      'Fault Tolerance' : level.replace('raid', '') or 'unknown',
+                      'Status'          : 'OK' if state == 'active' else 'Failed (%s)' % state,
+                      'Disk Name'       : '/dev/' + name}
+                pds = []
+                for field in fields:
+                    member = re.match(r'(\w+)\[\d+\](.*)', field)
+                    if not member:
+                        continue
+                    flags = member.group(2)
+                    disk = md_member_disk(member.group(1))
+                    rotational = read_sysfs(os.path.join(SYSFS, 'block', disk, 'queue/rotational'))
+                    size = read_sysfs(os.path.join(SYSFS, 'class/block', member.group(1), 'size'))
+                    pds.append({'physicaldrive'  : member.group(1),
+                                'Interface Type' : 'Solid State' if rotational == '0' else '',
+                                'Size'           : human_size(int(size) * 512) if size.isdigit() else None,
+                                'Status'         : 'Failed' if '(F)' in flags else 'OK',
+                                'Disk Name'      : '/dev/' + disk})
+                controller['arrays'].append({'name': name, 'details': {}, 'logical_drives': [ld], 'physical_drives': pds})
+            elif ld is not None and line.startswith(' '):
+                blocks = re.search(r'(\d+) blocks', line)
+                if blocks and 'Size' not in ld:
+                    ld['Size'] = human_size(int(blocks.group(1)) * 1024)
+                members = re.search(r'\[(\d+)/(\d+)\]', line)
+                if members and int(members.group(2)) < int(members.group(1)) and ld['Status'] == 'OK':
+                    ld['Status'] = 'Degraded (%s of %s drives)' % (members.group(2), members.group(1))
+                progress = re.search(r'(recovery|resync|reshape|check)\s*=\s*([\d.]+%)', line)
+                if progress:
+                    ld['Progress'] = '%s %s' % progress.groups()
+                    if progress.group(1) == 'recovery':
+                        ld['Status'] = 'Recovering %s' % progress.group(2)
             else:
-                log.info('RAID Status: OK')
-    except CalledProcessError:
-        pass
-    return raid_info
+                ld = None
+        if controller['arrays']:
+            self.controllers.append(controller)
+            
+    def location(self, pd):
+        return 'disk %s' % pd.get('Disk Name')
+        
+def md_member_disk(name, sysfs=None):
+    '''
+    returns the disk (eg sda) a md member (eg sda1) is on, a member that is a whole disk is it's own disk
+    '''
+    path = os.path.realpath(os.path.join(sysfs or SYSFS, 'class/block', name))
+    if os.path.exists(os.path.join(path, 'partition')):
+        return os.path.basename(os.path.dirname(path))
+    return name
     
-def get_smart_data(drives):
+RAID_BACKENDS = [ssacli_snapshot, storcli_snapshot, mdstat_snapshot]
+
+class raid_config():
+    '''
+    the RAID configuration from all the RAID backends, used the same way as a raid_snapshot
+    '''
+    def __init__(self, snapshots=[]):
+        self.snapshots = snapshots
+        
+    @property
+    def controllers(self):
+        return [controller for snapshot in self.snapshots for controller in snapshot.controllers]
+        
+    def find_disk(self, disk_name):
+        for snapshot in self.snapshots:
+            slot, logical_volumes = snapshot.find_disk(disk_name)
+            if logical_volumes:
+                return slot, logical_volumes
+        return None, []
+        
+    def raid_issues(self):
+        return ''.join(snapshot.raid_issues() for snapshot in self.snapshots)
+        
+    def fingerprints(self):
+        fingerprints = {}
+        for snapshot in self.snapshots:
+            fingerprints.update(snapshot.fingerprints())
+        return fingerprints
+        
+raid_backends = None    #names of the RAID backends to use, None for all of them
+raid_data = None
+
+def is_raid_member_command(cmd):
+    '''
+    returns True if cmd reads a physical drive behind a RAID controller, eg smartctl -a /dev/sdb -d cciss,3
+    '''
+    return '-d' in cmd[:-1] and ',' in cmd[cmd.index('-d') + 1]
+    
+def raid_member_serial(cmd):
+    '''
+    returns the serial number of the physical drive that cmd reads behind a RAID controller, from the RAID configuration
+    this run has already read (it isn't read here, as this is called while running commands), or None if it isn't known
+    '''
+    if raid_data is None or not is_raid_member_command(cmd):
+        return None
+    smart_device = cmd[cmd.index('-d') + 1]
+    for disk in [arg for arg in cmd if arg.startswith('/dev/')]:
+        for logical_volume in raid_data.find_disk(disk)[1]:
+            for physicaldrive in logical_volume['drives']:
+                if physicaldrive['smart_device'] == smart_device:
+                    return physicaldrive['serial']
+    return None
+
+def get_raid_backends():
+    return [backend for backend in RAID_BACKENDS if raid_backends is None or backend.name in raid_backends]
+    
+def raid_commands():
+    '''
+    returns the commands the RAID backends run to read their configuration, one for each backend that's installed
+    '''
+    return [command for command in [backend.command() for backend in get_raid_backends()] if command]
+    
+def get_raid_snapshot(refresh=False, results=None):
+    '''
+    returns the raid_config for this run, the RAID backends are only read the first time (or if refresh is True),
+    with their commands run at the same time
+    results is a dict of command: output (or the exception) for the commands already run, eg by lshw_drives
+    '''
+    global raid_data
+    if raid_data is None or refresh or results is not None:
+        results = dict(results or {})
+        commands = [command for command in raid_commands() if command not in results]
+        if commands:
+            results.update(zip(commands, run_commands(commands)))
+        raid_data = raid_config([backend.load(results) for backend in get_raid_backends()])
+    return raid_data
+    
+def get_smart_data(drives, workers=1, controller_workers=2, use_json=False, selftest=True):
+    '''
+    collect SMART data for all drives, if workers > 1 smartctl is run in parallel for up to workers drives,
+    with no more than controller_workers running at the same time on any one RAID controller
+    returns the same drive_data dict as a sequential run
+    if use_json is True, smartctl JSON output is used (needs smartctl 7.0 or later)
+    if selftest is True a short self test is run instead, if the time is midnight
+    '''
     drive_data = {}
     for drive in drives:
         if drives[drive]['SMART']:
-            drive_data[drive] = disk_info(drive, drives[drive])
+            drive_data[drive] = disk_info(drive, drives[drive], collect=False, use_json=use_json, selftest=selftest)
+    run_smart_commands(drive_data, disk_info.update_from_output, workers=workers, controller_workers=controller_workers)
     return drive_data
     
-def print_smart_data(drive_data):
+def run_smart_commands(drive_data, update, option=None, workers=1, controller_workers=2, only=None):
+    '''
+    run smartctl with option for every drive in drive_data, and call update(drive, lines, drive_no) with the output
+    only is a set of (drive name, drive_no) to limit it to some physical drives
+    '''
+    tasks = []
     for drive in drive_data.values():
         if drive.raid:
-            for drive_no in range(drive.num_drives):
-                #log.info('getting data for %s(%d), drive.power_on_hrs %s' % (drive.name,drive_no, len(drive.power_on_hrs) ))
-                if drive.ssd[drive_no]:
-                    ssd_text = ', Available Spare: {}%, Remaining life: {}%'.format(drive.spare[drive_no],drive.life[drive_no])
-                else:
-                    ssd_text = ''
-                text = 'Drive: %s(%d), Power On: %s, Temp: %s, LBA: %s, Status: %s%s' % (drive.name,drive_no,drive.power_on_hrs[drive_no] if drive.power_on_hrs[drive_no] is not None else 'unknown',
-                                                                       drive.temp[drive_no],
-                                                                       drive.bytes_written[drive_no] if drive.bytes_written[drive_no] is not None else 'unknown',
-                                                                       drive.smart_status[drive_no],
-                                                                       ssd_text)
-                log.info(text)    
+            controller = 'slot=%s' % drive.drive.get('controller_physid', drive.name)
         else:
-            if drive.ssd:
-                ssd_text = ', Available Spare: {}%, Remaining life: {}%'.format(drive.spare,drive.life)
-            else:
-                ssd_text = ''
-            text = 'Drive: %s, Power On: %s, Temp: %s, LBA: %s, Status: %s%s' % (drive.name,drive.power_on_hrs if drive.power_on_hrs is not None else 'unknown',
-                                                                   drive.temp,
-                                                                   drive.bytes_written if drive.bytes_written is not None else 'unknown',
-                                                                   drive.smart_status,
-                                                                   ssd_text)
-
-            log.info(text)
+            controller = drive.name  #plain disks and NVME drives are their own controller
+        for drive_no, cmd_string in drive.smart_commands(option):
+            if only is None or (drive.name, drive_no) in only:
+                tasks.append((controller, drive, drive_no, cmd_string))
+    
+    limits = {task[0] : threading.BoundedSemaphore(max(controller_workers,1)) for task in tasks}
+    
+    def collect(controller, drive, drive_no, cmd_string):
+        with limits[controller]:
+            start = time.time()
+            lines = drive.get_smart_output(cmd_string)
+        update(drive, lines, drive_no)
+        if workers > 1:
+            log.info('Drive: %s%s, SMART data collected in %.2fs' % (drive.name, '(%d)' % drive_no if drive_no is not None else '', time.time() - start))
+    
+    if workers <= 1:
+        for task in tasks:
+            collect(*task)
+        return
+        
+    #interleave the controllers, so that workers waiting on a busy controller don't hold up the others
+    controllers = {}
+    for task in tasks:
+        controllers.setdefault(task[0], []).append(task)
+    queue = [task for group in zip_longest(*controllers.values()) for task in group if task is not None]
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='smart') as executor:
+        futures = [executor.submit(collect, *task) for task in queue]
+        for future in futures:
+            future.result()
+    log.info('SMART data for %d drives collected in %.2fs using %d workers' % (len(queue), time.time() - start, workers))
+    
+def print_smart_data(drive_data):
+    for drive in drive_data.values():
+        for record in drive.records:
+            log.info(record.text())
             
 def get_smart_data_summary(drive_data):
     drive_issues = ''
     for drive in drive_data.values():
-        if drive.raid:
-            for drive_no in range(drive.num_drives):
-                if drive.smart_status[drive_no] != 'OK':
-                    if drive.ssd[drive_no]:
-                        ssd_text = ', Available Spare: {}%, Remaining life: {}%'.format(drive.spare[drive_no], drive.life[drive_no])
-                    else:
-                        ssd_text = ''
-                    drive_issues+= 'Drive: %s(%d), Power On: %s, Temp: %s, LBA: %s, Status: %s%s\n' % (drive.name,drive_no,drive.power_on_hrs[drive_no] if drive.power_on_hrs[drive_no] is not None else 'unknown',
-                                                                           drive.temp[drive_no],
-                                                                           drive.bytes_written[drive_no] if drive.bytes_written[drive_no] is not None else 'unknown',
-                                                                           drive.smart_status[drive_no],
-                                                                           ssd_text)
-                    
-        else:
-            if drive.smart_status != 'OK':
-                if drive.ssd:
-                    ssd_text = ', Available Spare: {}%, Remaining life: {}%'.format(drive.spare, drive.life)
-                else:
-                    ssd_text = ''
-                drive_issues+= 'Drive: %s, Power On: %s, Temp: %s, LBA: %s, Status: %s%s\n' % (drive.name,drive.power_on_hrs if drive.power_on_hrs is not None else 'unknown',
-                                                                       drive.temp,
-                                                                       drive.bytes_written if drive.bytes_written is not None else 'unknown',
-                                                                       drive.smart_status,
-                                                                       ssd_text)
+        for record in drive.records:
+            if record.smart_status != 'OK':
+                drive_issues += record.text() + '\n'
     if drive_issues == '':
         return 'All drives OK, ', True
     return drive_issues, False
@@ -471,10 +2239,14 @@ def is_virtual():
     #needs virt-what installed
     cmd_string = '/usr/sbin/virt-what'
     try:
-        VM = check_output(cmd_string.split())
-    except CalledProcessError as e:
+        VM = run_command(cmd_string)
+    except (CalledProcessError, TimeoutExpired) as e:
         log.warning('WARN: could not determine virtual environment!: error: %s' % e.output)
         return False
+    except OSError as e:
+        #virt-what isn't installed (or wasn't recorded)
+        log.warning('WARN: could not determine virtual environment!: error: %s' % e)
+        return False
     if len(VM) != 0:
         log.info('Running in: VM %s' % VM.decode('utf-8'))
         return True
@@ -482,6 +2254,1095 @@ def is_virtual():
         log.info('Running on Host')
     return False
 
+def combine_summary(summary, status, raid_issues):
+    '''
+    add any RAID issues to the drive summary, returns summary, status
+    '''
+    if raid_issues != "":
+        if not status:
+            summary += raid_issues
+        else:
+            summary = raid_issues
+        status = False
+    return summary, status
+    
+#version of the summary file JSON, increase if a field is changed or removed (adding fields is fine)
+SUMMARY_VERSION = 1
+
+def get_summary_data(drive_data, summary, status, raid_issues='', wear_warnings='', duration=None, timestamp=None):
+    '''
+    returns the contents of the summary file as a dict:
+    version, hostname, timestamp, duration (seconds taken to collect the data), status (True if all OK), summary text,
+    drives (a list of the status and numeric values of each physical drive), raid and wear (lists of issues),
+    partial (True if any drive or RAID controller didn't answer in time) and timeouts (the drives that didn't)
+    '''
+    drives = []
+    for name, drive in drive_data.items():
+        for record in drive.records:
+            values = {'drive': record.label(), 'status': record.smart_status}
+            values.update((value, record.raw.get(value)) for value in HISTORY_VALUES)
+            drives.append(values)
+    return {'version'   : SUMMARY_VERSION,
+            'hostname'  : socket.gethostname(),
+            'timestamp' : time.time() if timestamp is None else timestamp,
+            'duration'  : duration,
+            'status'    : status,
+            'summary'   : summary if summary != '' else 'no data',
+            'drives'    : drives,
+            'raid'      : raid_issues.splitlines(),
+            'wear'      : wear_warnings.splitlines(),
+            'partial'   : any(values['status'] == SMART_TIMEOUT for values in drives) or SMART_TIMEOUT in raid_issues + summary,
+            'timeouts'  : [values['drive'] for values in drives if values['status'] == SMART_TIMEOUT]}
+            
+def write_summary_file(summary_file, data):
+    '''
+    write data (see get_summary_data) to summary_file as JSON
+    it is written to a temporary file that is renamed over summary_file, so a reader (eg a VM on a shared mount)
+    never sees a half written file, and the file's modification time is set to data['timestamp'] for summary_file_age
+    '''
+    temp_file = '%s.%d.tmp' % (summary_file, os.getpid())
+    try:
+        with open(temp_file, 'w') as f:
+            json.dump(data, f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.utime(temp_file, (data['timestamp'], data['timestamp']))
+        os.replace(temp_file, summary_file)
+    except Exception as e:
+        log.warning('Error writing summary file: %s' % e)
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+            
+def summary_file_age(summary_file):
+    '''
+    returns the age in seconds of the data in summary_file, from its modification time, without reading it
+    '''
+    return time.time() - os.stat(summary_file).st_mtime
+    
+def read_summary_file(summary_file, max_age=None):
+    '''
+    returns the data (see get_summary_data) in a summary file written by write_summary_file
+    or None if max_age is given and the data is older than that, which is checked before the file is read
+    old text files ('timestamp summary') are returned as version 0, with just timestamp, status and summary
+    '''
+    if max_age is not None and summary_file_age(summary_file) > max_age:
+        return None
+    with open(summary_file, 'r') as f:
+        disk_data = f.read()
+    if disk_data.startswith('{'):
+        data = json.loads(disk_data)
+    else:
+        disk_time = disk_data.split(' ').pop(0)
+        summary = disk_data[len(disk_time):].strip()
+        data = {'version': 0, 'timestamp': float(disk_time), 'status': summary.startswith('All drives OK'), 'summary': summary}
+    if max_age is not None and time.time() - max_age > data['timestamp']:
+        return None
+    return data
+    
+def next_time_at(at, now=None):
+    '''
+    returns the next time (seconds since the epoch) that the local time will be at, at is 'HH:MM'
+    '''
+    now = dt.datetime.fromtimestamp(now if now is not None else time.time())
+    hour, minute = [int(value) for value in at.split(':')]
+    next_time = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if next_time <= now:
+        next_time += dt.timedelta(days=1)
+    return next_time.timestamp()
+    
+#numeric SMART values kept in the history database, from the raw values of each physical drive
+HISTORY_VALUES = ['temp', 'bytes_written', 'power_on_hrs', 'life', 'spare']
+
+#values that wear trends are kept for (remaining life %, and bytes written for the write rate)
+WEAR_VALUES = ['life', 'bytes_written']
+
+class wear_trend():
+    '''
+    exponentially weighted least squares fit of a value against time (in days), updated one reading at a time
+    so the trend never needs the full history, older readings fade out with a half life of half_life days
+    times are days from origin, and values are relative to base (the first reading) to keep the sums accurate
+    '''
+    SUMS = ['weight', 'sum_x', 'sum_y', 'sum_xx', 'sum_xy']
+    
+    def __init__(self, origin, base, half_life=30, count=0, last_ts=None, last_value=None, **sums):
+        self.origin = origin
+        self.base = base
+        self.half_life = half_life
+        self.count = count
+        self.last_ts = last_ts
+        self.last_value = last_value
+        for name in self.SUMS:
+            setattr(self, name, sums.get(name, 0.0))
+            
+    def add(self, ts, value):
+        if self.last_ts is not None and ts <= self.last_ts:
+            return
+        decay = 0.5 ** ((ts - self.last_ts) / (self.half_life * 86400)) if self.last_ts is not None else 1.0
+        x = (ts - self.origin) / 86400
+        y = value - self.base
+        self.weight  = self.weight * decay + 1
+        self.sum_x   = self.sum_x * decay + x
+        self.sum_y   = self.sum_y * decay + y
+        self.sum_xx  = self.sum_xx * decay + x * x
+        self.sum_xy  = self.sum_xy * decay + x * y
+        self.count += 1
+        self.last_ts = ts
+        self.last_value = value
+        
+    def slope(self):
+        '''
+        returns the change in value per day, or None if there isn't enough history yet (3 readings over a day)
+        '''
+        spread = self.weight * self.sum_xx - self.sum_x ** 2
+        if self.count < 3 or self.last_ts - self.origin < 86400 or spread <= 0:
+            return None
+        return (self.weight * self.sum_xy - self.sum_x * self.sum_y) / spread
+        
+    def value_at(self, ts):
+        '''
+        returns the value of the fitted line at ts
+        '''
+        x = (ts - self.origin) / 86400
+        return self.base + self.sum_y / self.weight + (self.slope() or 0) * (x - self.sum_x / self.weight)
+        
+    def days_until(self, threshold, ts):
+        '''
+        returns the days from ts until the value falls to threshold, or None if it isn't falling
+        '''
+        slope = self.slope()
+        if not slope or slope >= 0:
+            return None
+        return max(0, (threshold - self.value_at(ts)) / slope)
+        
+class history_store():
+    '''
+    SMART history in an SQLite database (in WAL mode), one row per physical drive per poll with the numeric values
+    member is the physical drive number for RAID volumes, -1 otherwise, ok is 1 if the SMART status was OK
+    to keep the database bounded, rows older than raw_days are averaged into hourly rows, hourly rows older than
+    hourly_days into daily rows, and daily rows older than keep_days are deleted
+    '''
+    HOUR = 3600
+    DAY = 86400
+    
+    def __init__(self, path, raw_days=2, hourly_days=90, keep_days=1825, half_life=30):
+        self.path = path
+        self.raw_days = raw_days
+        self.hourly_days = hourly_days
+        self.keep_days = keep_days
+        self.half_life = half_life
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            #the primary key is the index for range queries by drive and time
+            self.db.execute('CREATE TABLE IF NOT EXISTS samples (drive TEXT NOT NULL, member INTEGER NOT NULL, ts REAL NOT NULL, '
+                            'period INTEGER NOT NULL DEFAULT 0, samples INTEGER NOT NULL DEFAULT 1, ok INTEGER, %s, '
+                            'PRIMARY KEY (drive, member, ts)) WITHOUT ROWID' % ', '.join('%s REAL' % name for name in HISTORY_VALUES))
+            self.db.execute('CREATE INDEX IF NOT EXISTS samples_period ON samples (period, ts)')
+            #the running wear_trend state for each drive, updated on each append
+            self.db.execute('CREATE TABLE IF NOT EXISTS trends (drive TEXT NOT NULL, member INTEGER NOT NULL, value TEXT NOT NULL, '
+                            'origin REAL, base REAL, count INTEGER, last_ts REAL, last_value REAL, %s, '
+                            'PRIMARY KEY (drive, member, value)) WITHOUT ROWID' % ', '.join('%s REAL' % name for name in wear_trend.SUMS))
+            
+    def rows(self, drive_data, ts):
+        for name, drive in drive_data.items():
+            for values in drive.as_dict()['drives']:
+                status = values['smart_status']
+                #a drive that didn't answer in time has no known status, rather than a failed one
+                yield ([name, -1 if values['drive_no'] is None else values['drive_no'], ts, None if status in [None, SMART_TIMEOUT] else int(status == 'OK')] +
+                       [values['raw'].get(value) for value in HISTORY_VALUES])
+                
+    def append(self, drive_data, ts=None):
+        '''
+        add a row for each physical drive in drive_data (a dict of disk_info), then downsample old rows
+        returns the number of rows added
+        '''
+        ts = time.time() if ts is None else ts
+        rows = list(self.rows(drive_data, ts))
+        trends = self.trends()
+        with self.lock, self.db:
+            for row in rows:
+                values = dict(zip(HISTORY_VALUES, row[4:]))
+                for name in WEAR_VALUES:
+                    if values[name] is None:
+                        continue
+                    key = (row[0], row[1], name)
+                    if key not in trends:
+                        #first time for this drive, start from what is already in the history
+                        trends[key] = wear_trend(ts, values[name], self.half_life)
+                        for old in self.db.execute('SELECT ts, %s FROM samples WHERE drive = ? AND member = ? AND %s IS NOT NULL ORDER BY ts' % (name, name), key[:2]):
+                            if trends[key].count == 0:
+                                trends[key] = wear_trend(old[0], old[1], self.half_life)
+                            trends[key].add(*old)
+                    trends[key].add(ts, values[name])
+            self.db.executemany('INSERT OR REPLACE INTO samples (drive, member, ts, ok, %s) VALUES (?, ?, ?, ?, %s)' % (', '.join(HISTORY_VALUES),
+                                                                                                                   ', '.join('?' * len(HISTORY_VALUES))), rows)
+            self.db.executemany('INSERT OR REPLACE INTO trends VALUES (?, ?, ?, ?, ?, ?, ?, ?, %s)' % ', '.join('?' * len(wear_trend.SUMS)),
+                                [list(key) + [trend.origin, trend.base, trend.count, trend.last_ts, trend.last_value] +
+                                 [getattr(trend, name) for name in wear_trend.SUMS] for key, trend in trends.items()])
+        self.downsample(ts)
+        return len(rows)
+        
+    def trends(self):
+        '''
+        returns a dict of (drive, member, value name): wear_trend
+        '''
+        trends = {}
+        with self.lock:
+            cursor = self.db.execute('SELECT * FROM trends')
+            columns = [column[0] for column in cursor.description]
+            for row in cursor:
+                state = dict(zip(columns, row))
+                key = (state.pop('drive'), state.pop('member'), state.pop('value'))
+                trends[key] = wear_trend(half_life=self.half_life, **state)
+        return trends
+        
+    def wear_projections(self, threshold=10, now=None):
+        '''
+        returns a list of dicts of drive, member, life (remaining life %), days (until life falls to threshold %, or None)
+        and write_rate (bytes written per day, or None), for each drive with a remaining life history
+        '''
+        now = time.time() if now is None else now
+        trends = self.trends()
+        projections = []
+        for (drive, member, name), trend in sorted(trends.items()):
+            if name != 'life':
+                continue
+            writes = trends.get((drive, member, 'bytes_written'))
+            projections.append({'drive'      : drive,
+                                'member'     : member,
+                                'life'       : trend.last_value,
+                                'days'       : trend.days_until(threshold, now),
+                                'write_rate' : writes.slope() if writes else None})
+        return projections
+        
+    def downsample(self, now=None):
+        '''
+        average rows older than the retention time for their period into longer periods, and delete the oldest rows
+        only whole hours/days are averaged, so each new row is complete
+        '''
+        now = time.time() if now is None else now
+        with self.lock, self.db:
+            for period, new_period, days in [(0, self.HOUR, self.raw_days), (self.HOUR, self.DAY, self.hourly_days)]:
+                cutoff = int(now - days * self.DAY)
+                cutoff -= cutoff % new_period
+                self.db.execute('INSERT OR REPLACE INTO samples (drive, member, ts, period, samples, ok, %s) '
+                                'SELECT drive, member, CAST(ts AS INTEGER) - CAST(ts AS INTEGER) %% ? AS bucket, ?, SUM(samples), MIN(ok), '
+                                'AVG(temp), MAX(bytes_written), MAX(power_on_hrs), MIN(life), MIN(spare) '
+                                'FROM samples WHERE period = ? AND ts < ? GROUP BY drive, member, bucket' % ', '.join(HISTORY_VALUES),
+                                (new_period, new_period, period, cutoff))
+                self.db.execute('DELETE FROM samples WHERE period = ? AND ts < ?', (period, cutoff))
+            self.db.execute('DELETE FROM samples WHERE period = ? AND ts < ?', (self.DAY, now - self.keep_days * self.DAY))
+            
+    def query(self, drive, member=None, start=None, end=None):
+        '''
+        returns a list of dicts of the rows for drive (and member) from start to end (seconds since the epoch), oldest first
+        '''
+        sql = 'SELECT drive, member, ts, period, samples, ok, %s FROM samples WHERE drive = ?' % ', '.join(HISTORY_VALUES)
+        params = [drive]
+        if member is not None:
+            sql += ' AND member = ?'
+            params.append(member)
+        if start is not None:
+            sql += ' AND ts >= ?'
+            params.append(start)
+        if end is not None:
+            sql += ' AND ts <= ?'
+            params.append(end)
+        sql += ' ORDER BY member, ts'
+        with self.lock:
+            cursor = self.db.execute(sql, params)
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor]
+            
+    def drives(self):
+        '''
+        returns a list of the drive names in the history
+        '''
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT DISTINCT drive FROM samples ORDER BY drive')]
+            
+    def close(self):
+        with self.lock:
+            self.db.close()
+            
+def get_wear_warnings(history, threshold=10, horizon=90):
+    '''
+    returns a line for each drive that is projected to wear down to threshold % remaining life within horizon days
+    '''
+    wear_warnings = ''
+    for projection in history.wear_projections(threshold):
+        if projection['days'] is not None and projection['days'] <= horizon:
+            wear_warnings += 'Drive: %s%s, Remaining life: %g%%, projected to reach %g%% in %d days%s\n' % (
+                             projection['drive'], '(%d)' % projection['member'] if projection['member'] >= 0 else '',
+                             projection['life'], threshold, projection['days'],
+                             ', writing %s/day' % human_size(projection['write_rate']) if (projection['write_rate'] or 0) > 0 else '')
+    return wear_warnings
+    
+def print_history(history, drives=None, days=7):
+    '''
+    log the history of drives (all drives if None) for the last days
+    '''
+    def number(value):
+        return '%g' % value if value is not None else 'unknown'
+        
+    start = time.time() - days * history_store.DAY
+    for name in drives or history.drives():
+        for row in history.query(name, start=start):
+            log.info('Drive: %s%s, Time: %s, Power On: %s, Temp: %s, LBA: %s, Status: %s, Available Spare: %s, Remaining life: %s' % (
+                     name, '(%d)' % row['member'] if row['member'] >= 0 else '',
+                     dt.datetime.fromtimestamp(row['ts']).strftime('%Y-%m-%d %H:%M:%S'),
+                     number(row['power_on_hrs']), number(row['temp']),
+                     human_size(row['bytes_written']) if row['bytes_written'] is not None else 'unknown',
+                     {None: 'unknown', 0: 'FAILED!', 1: 'OK'}[row['ok']],
+                     number(row['spare']), number(row['life'])))
+            
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_ACTIONS = ('add', 'remove', 'change')
+
+def parse_uevent(data):
+    '''
+    returns the properties of a kernel uevent (b'change@/devices/...\0ACTION=change\0DEVPATH=/devices/...\0...') as a dict,
+    or None if data isn't one (eg a message from udevd)
+    '''
+    fields = data.split(b'\0')
+    if b'@' not in fields[0]:
+        return None
+    event = {}
+    for field in fields[1:]:
+        key, sep, value = field.partition(b'=')
+        if sep:
+            event[key.decode('utf8', 'replace')] = value.decode('utf8', 'replace')
+    if 'ACTION' not in event or 'DEVPATH' not in event:
+        return None
+    return event
+    
+class uevent_watcher():
+    '''
+    listens for the kernel's hot plug events (uevents) on a netlink socket in a background thread
+    calls callback(action, drive name) when a disk is added, removed or changed (a partition change is a change of it's disk),
+    and callback(action, None) for SCSI device events, which can mean a RAID controller's logical drives have changed
+    if events are lost because the socket's buffer overflowed, callback('overflow', None) is called
+    sock can be given to feed it events from somewhere else, eg a socketpair
+    '''
+    def __init__(self, callback, sock=None):
+        self.callback = callback
+        if sock is None:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+            sock.bind((0, 1))   #multicast group 1 is the kernel's events
+        sock.settimeout(1)
+        self.sock = sock
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='uevents', daemon=True)
+        self.thread.start()
+        
+    def run(self):
+        while self.running:
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                if not self.running:
+                    break
+                if e.errno == errno.ENOBUFS:
+                    log.warning('missed some uevents, the receive buffer overflowed')
+                    self.callback('overflow', None)
+                    continue
+                log.warning('stopped watching for uevents: %s' % e)
+                break
+            event = parse_uevent(data)
+            if event is not None:
+                self.handle(event)
+                
+    def handle(self, event):
+        action = event['ACTION']
+        if action not in UEVENT_ACTIONS:
+            return
+        log.debug('uevent: %s %s' % (action, event['DEVPATH']))
+        if event.get('SUBSYSTEM') == 'block' and event.get('DEVTYPE') in ['disk', 'partition']:
+            if event['DEVTYPE'] == 'partition':
+                action = 'change'
+                dev = os.path.basename(os.path.dirname(event['DEVPATH']))
+            else:
+                dev = os.path.basename(event['DEVPATH'])
+            if not dev.startswith(IGNORE_BLOCK_DEVICES):
+                self.callback(action, '/dev/' + dev)
+        elif event.get('SUBSYSTEM') == 'scsi':
+            self.callback(action, None)
+            
+    def stop(self):
+        self.running = False
+        self.thread.join(2)
+        self.sock.close()
+        
+class drive_daemon():
+    '''
+    long running mode, keeps the drive topology and the latest SMART data in memory, and polls the drives on a schedule
+    jobs are run in the order they become due, the self test runs at a fixed time each day
+    with arg.adaptive, each physical drive has it's own interval between full SMART reads (see poll_adaptive)
+    with arg.hotplug, drives that are added, removed or changed are found from uevents as it happens (see hotplug)
+    '''
+    HOTPLUG_DELAY = 2   #seconds to collect a burst of uevents (eg a disk and it's partitions) into one hotplug job
+    
+    def __init__(self, arg, drives, config_file='config.ini', use_json=False):
+        self.arg = arg
+        self.drives = drives
+        self.config_file = config_file
+        self.use_json = use_json
+        self.lock = threading.RLock()
+        self.running = True
+        self.wakeup = threading.Event()
+        self.drive_data = {}
+        self.raid_issues = ''
+        self.wear_warnings = ''
+        self.raid_snapshot = raid_config()
+        self.schedule = {}  #(drive name, drive_no): interval, due time and last state, for adaptive polling
+        self.uevents = {}   #drive name (None for SCSI events): action, waiting for the hotplug job
+        self.watcher = None
+        self.updated = {}
+        self.version = 0    #incremented whenever the data changes
+        self.jobs = []
+        self.server = None
+        self.history = history_store(arg.history) if arg.history else None
+        if arg.adaptive:
+            self.add_job('adaptive', self.poll_adaptive, interval=arg.healthinterval)
+        else:
+            self.add_job('attributes', self.poll_attributes, interval=arg.pollinterval)
+            self.add_job('health', self.poll_health, interval=arg.healthinterval, first=time.time() + arg.healthinterval)
+        self.add_job('raid', self.check_raid, interval=arg.raidinterval)
+        if arg.selftest:
+            self.add_job('self test', self.self_test, at=arg.selftest)
+        if arg.drivedbmaxage > 0 and not arg.replay:
+            self.add_job('drive database', get_drive_database().refresh_in_background, interval=3600, first=time.time() + 3600)
+        
+    def add_job(self, name, func, interval=None, at=None, first=None):
+        '''
+        add a job to run every interval seconds, or every day at 'HH:MM' if at is given
+        if neither is given, the job is run once
+        '''
+        if first is None:
+            first = next_time_at(at) if at else time.time()
+        self.jobs.append({'name':name, 'func':func, 'interval':interval, 'at':at, 'due':first})
+        self.wakeup.set()
+        
+    def run_smart_commands(self, update, option=None, only=None, drive_data=None):
+        '''
+        run smartctl for the drives in drive_data (default self.drive_data), the output is collected first,
+        then update is called for all of it while holding the lock, so the API never sees a half updated drive
+        a new drive_data is published as self.drive_data under the same lock
+        '''
+        new = drive_data is not None
+        with self.lock:
+            drive_data = drive_data if new else self.drive_data
+        results = []
+        run_smart_commands(drive_data, lambda drive, lines, drive_no: results.append((drive, lines, drive_no)), option,
+                           self.arg.workers, self.arg.controllerworkers, only)
+        with self.lock:
+            for drive, lines, drive_no in results:
+                update(drive, lines, drive_no)
+            if new:
+                self.drive_data = drive_data
+            self.version += 1
+        
+    def poll_attributes(self):
+        '''
+        read all the SMART data, the disk_info for each drive is kept between polls and it's records updated in place
+        (under the lock, see run_smart_commands), new ones are only made for drives that have been added or changed (eg by a rescan)
+        '''
+        with self.lock:
+            drives = self.drives
+            current = dict(self.drive_data)
+        drive_data = {}
+        for name, drive in drives.items():
+            if not drive['SMART']:
+                continue
+            if name in current and current[name].drive == drive:
+                drive_data[name] = current[name]
+            else:
+                drive_data[name] = disk_info(name, drive, collect=False, use_json=self.use_json, selftest=False)
+        self.run_smart_commands(disk_info.update_from_output, drive_data=drive_data)
+        with self.lock:
+            self.schedule = {}
+            self.schedule_drives(drive_data)
+        self.update_history(drive_data)
+        
+    def schedule_drives(self, drive_data):
+        now = time.time()
+        for name, drive in drive_data.items():
+            for record in drive.records:
+                interval = self.arg.pollinterval if record.smart_status == 'OK' else self.arg.healthinterval
+                self.schedule[(name, record.drive_no)] = {'interval' : interval,
+                                                          'due'      : now + interval,
+                                                          'state'    : self.drive_state(record)}
+        
+    def update_history(self, drive_data):
+        if self.history:
+            self.history.append(drive_data)
+            wear_warnings = get_wear_warnings(self.history, self.arg.wearthreshold, self.arg.wearhorizon)
+            with self.lock:
+                self.wear_warnings = wear_warnings
+                
+    def drive_state(self, record):
+        return (record.smart_status, record.raw.get('temp'))
+        
+    def poll_adaptive(self):
+        '''
+        read all the SMART data for the drives that are due, and just check the health (smartctl -H) of the rest
+        healthy drives with stable values are read less and less often (up to arg.maxinterval), drives with problems,
+        or whose health, temperature or RAID status changes, are read on every poll until they settle down again
+        '''
+        if not self.drive_data:
+            self.poll_attributes()
+            return
+        now = time.time()
+        with self.lock:
+            #anything due before the next poll is half way, so drives on the fastest interval are read every poll
+            due = {key for key, schedule in self.schedule.items() if schedule['due'] <= now + self.arg.healthinterval / 2}
+            health = set(self.schedule.keys()) - due
+        log.debug('adaptive poll: %d full reads, %d health checks' % (len(due), len(health)))
+        if due:
+            self.run_smart_commands(disk_info.update_from_output, only=due)
+        if health:
+            self.run_smart_commands(disk_info.update_health, '-H', only=health)
+        with self.lock:
+            for key in due:
+                schedule = self.schedule[key]
+                state = self.drive_state(self.drive_data[key[0]].record(key[1]))
+                if state[0] == 'OK' and self.is_stable(schedule['state'], state):
+                    schedule['interval'] = min(schedule['interval'] * 2, max(self.arg.maxinterval, self.arg.pollinterval))
+                else:
+                    schedule['interval'] = self.arg.healthinterval
+                schedule['state'] = state
+                schedule['due'] = now + schedule['interval']
+            for key in health:
+                smart_status = self.drive_data[key[0]].record(key[1]).smart_status
+                if smart_status != 'OK' or smart_status != self.schedule[key]['state'][0]:
+                    self.tighten(key, 'SMART status %s' % smart_status)
+        if due:
+            self.update_history({name: drive for name, drive in self.drive_data.items() if any(key[0] == name for key in due)})
+            
+    def is_stable(self, old, new, max_temp_change=5):
+        if old[0] != new[0]:
+            return False
+        if old[1] is not None and new[1] is not None and abs(new[1] - old[1]) > max_temp_change:
+            return False
+        return True
+        
+    def tighten(self, key, reason):
+        '''
+        read all the SMART data for the physical drive key on the next poll, and every poll after that until it's stable
+        '''
+        schedule = self.schedule.get(key)
+        if schedule and schedule['interval'] != self.arg.healthinterval:
+            log.info('Drive: %s%s, %s, polling every %ss' % (key[0], '(%d)' % key[1] if key[1] is not None else '', reason, self.arg.healthinterval))
+            schedule['interval'] = self.arg.healthinterval
+            schedule['due'] = 0
+            
+    def poll_health(self):
+        if not self.drive_data:
+            return
+        self.run_smart_commands(disk_info.update_health, '-H')
+        
+    def check_raid(self):
+        raid_issues = check_raid_failures(self.arg, refresh=True)
+        with self.lock:
+            if raid_issues != self.raid_issues:
+                #RAID status changed, so read the drives behind the RAID controllers on the next adaptive poll
+                for name, drive_no in self.schedule.keys():
+                    if self.drive_data[name].raid:
+                        self.tighten((name, drive_no), 'RAID status changed')
+            self.raid_issues = raid_issues
+            self.raid_snapshot = get_raid_snapshot()
+            
+    def self_test(self):
+        log.info('running self test')
+        self.run_smart_commands(lambda drive, lines, drive_no: None, '-t short')
+        
+    def rescan(self):
+        get_raid_snapshot(refresh=True)
+        drives = rescan_drives(self.config_file)
+        with self.lock:
+            self.drives = drives
+        self.poll_attributes()
+        
+    def uevent(self, action, name):
+        '''
+        called by the uevent_watcher, the events over HOTPLUG_DELAY seconds are handled by one hotplug job
+        '''
+        with self.lock:
+            pending = bool(self.uevents)
+            if self.uevents.get(name) != 'overflow':
+                self.uevents[name] = action
+        if not pending:
+            self.add_job('hotplug', self.hotplug, first=time.time() + self.HOTPLUG_DELAY)
+            
+    def hotplug(self):
+        '''
+        update the drive map for just the drives in the uevents, read their SMART data straight away,
+        and check the RAID status if a RAID volume or SCSI device was involved
+        '''
+        with self.lock:
+            events, self.uevents = self.uevents, {}
+            drives = dict(self.drives)
+        if events.get(None) == 'overflow':
+            log.info('uevents were missed, checking all the drives')
+            self.rescan()
+            return
+        removed = [name for name, action in events.items() if name in drives and action == 'remove']
+        changed = [name for name, action in events.items() if name and action != 'remove' and os.path.exists(os.path.join(SYSFS, 'block', os.path.basename(name)))]
+        for name in changed:
+            if name not in drives and is_raid_volume(name):
+                log.info('RAID volume %s has been added, doing full rescan' % name)
+                self.rescan()
+                self.check_raid()
+                return
+        check_raid = None in events or any('controller_physid' in drives[name] for name in removed + changed if name in drives)
+        for name in removed:
+            log.info('drive %s has been removed' % name)
+            del drives[name]
+        if changed:
+            log.info('drives added or changed: %s' % ', '.join(changed))
+            drives.update(probe_drives(changed, drives))
+        save_drives(drives, self.config_file)
+        drive_data = get_smart_data({name: drives[name] for name in changed if name in drives}, self.arg.workers,
+                                    self.arg.controllerworkers, self.use_json, selftest=False)
+        with self.lock:
+            self.drives = drives
+            self.drive_data = {name: drive for name, drive in self.drive_data.items() if name in drives and name not in changed}
+            self.drive_data.update(drive_data)
+            self.schedule = {key: schedule for key, schedule in self.schedule.items() if key[0] in self.drive_data and key[0] not in changed}
+            self.schedule_drives(drive_data)
+        self.update_history(drive_data)
+        if check_raid:
+            self.check_raid()
+            
+    def status(self):
+        '''
+        returns summary, status from the latest data in memory
+        '''
+        with self.lock:
+            summary, status = get_smart_data_summary(self.drive_data)
+            summary, status = combine_summary(summary, status, self.raid_issues)
+            return combine_summary(summary, status, self.wear_warnings)
+            
+    def snapshot(self):
+        '''
+        returns the latest data in memory as a dict, for the query API
+        '''
+        with self.lock:
+            summary, status = self.status()
+            return {'hostname'  : socket.gethostname(),
+                    'timestamp' : max(self.updated.values()) if self.updated else None,
+                    'updated'   : dict(self.updated),
+                    'status'    : status,
+                    'summary'   : summary,
+                    'raid'      : self.raid_issues,
+                    'drives'    : {name : drive.as_dict() for name, drive in self.drive_data.items()}}
+            
+    def metrics(self):
+        '''
+        returns the latest data in memory in the Prometheus text format
+        '''
+        with self.lock:
+            return get_metrics(self.drive_data, self.drives, self.raid_snapshot, self.updated)
+            
+    def run_job(self, job):
+        start = time.time()
+        try:
+            with timer.stage(job['name']):
+                job['func']()
+        except Exception as e:
+            log.exception('error in %s job: %s' % (job['name'], e))
+        with self.lock:
+            self.updated[job['name']] = time.time()
+            self.version += 1
+        log.debug('%s job took %.2fs' % (job['name'], time.time() - start))
+        if job['at']:
+            job['due'] = next_time_at(job['at'])
+        elif job['interval']:
+            job['due'] = max(job['due'] + job['interval'], time.time())
+        else:
+            self.jobs.remove(job)
+        with self.lock:
+            summary, status = self.status()
+            data = get_summary_data(self.drive_data, summary, status, self.raid_issues, self.wear_warnings, time.time() - start)
+        write_summary_file(self.arg.writesummaryfile, data)
+        
+    def report(self):
+        print_smart_data(self.drive_data)
+        log.info('Summary: %s' % self.status()[0].strip())
+        log.info('timing report: %s' % json.dumps(timer.report(get_runner().stats), sort_keys=True))
+        
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.add_job('rescan', self.rescan)
+        elif signum == signal.SIGUSR1:
+            self.add_job('report', self.report)
+        else:
+            self.running = False
+            self.wakeup.set()
+        
+    def run(self):
+        for signum in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGUSR1]:
+            signal.signal(signum, self.handle_signal)
+        log.info('running as daemon, attributes every %ss, health every %ss, RAID every %ss, self test at %s' % (self.arg.pollinterval,
+                                                                                                                  self.arg.healthinterval,
+                                                                                                                  self.arg.raidinterval,
+                                                                                                                  self.arg.selftest))
+        if self.arg.api:
+            self.server = start_status_server(self.arg.api, self)
+        if self.arg.hotplug:
+            try:
+                self.watcher = uevent_watcher(self.uevent)
+            except OSError as e:
+                log.warning('could not watch for uevents, drive changes need a SIGHUP: %s' % e)
+        while self.running:
+            self.wakeup.clear()
+            job = min(self.jobs, key=lambda job: job['due'])
+            if job['due'] > time.time():
+                #wait for the job to be due, or for a signal to add a job/stop
+                self.wakeup.wait(job['due'] - time.time())
+                continue
+            self.run_job(job)
+        if self.watcher:
+            self.watcher.stop()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.history:
+            self.history.close()
+        log.info('daemon stopped')
+        
+class status_request_handler(BaseHTTPRequestHandler):
+    '''
+    serves the daemon's cached drive data as JSON
+    GET / or /status: everything, /drives: just the drive data, /raid: just the RAID status, /metrics: Prometheus metrics
+    responses have an ETag, and If-None-Match gets a 304 if nothing has changed
+    '''
+    protocol_version = 'HTTP/1.1'  #keep connections open, for pollers like fleet_aggregator
+    timeout = 60                    #close idle connections
+    paths = {'/'        : None,
+             '/status'  : None,
+             '/drives'  : 'drives',
+             '/raid'    : 'raid',
+             '/metrics' : 'metrics'}
+    content_types = {'/metrics' : 'text/plain; version=0.0.4; charset=utf-8'}
+             
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/') or '/'
+        if path not in self.paths:
+            self.send_error(404)
+            return
+        body, etag = self.server.get_body(path, self.paths[path])
+        if etag in [tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')]:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', self.content_types.get(path, 'application/json'))
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+        
+    def address_string(self):
+        if isinstance(self.client_address, tuple) and self.client_address:
+            return self.client_address[0]
+        return 'unix socket'
+        
+    def log_message(self, format, *args):
+        log.debug('API: %s - %s' % (self.address_string(), format % args))
+        
+class status_server_mixin():
+    '''
+    keeps the JSON for each path cached until the daemon's data changes, so requests are cheap
+    '''
+    def setup_cache(self, daemon):
+        self.drive_daemon = daemon
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        
+    def get_body(self, path, key):
+        with self.cache_lock:
+            version = self.drive_daemon.version
+            if path not in self.cache or self.cache[path][0] != version:
+                if key == 'metrics':
+                    body = self.drive_daemon.metrics().encode('utf8')
+                else:
+                    data = self.drive_daemon.snapshot()
+                    if key:
+                        data = {'hostname': data['hostname'], 'timestamp': data['timestamp'], key: data[key]}
+                    body = json.dumps(data, indent=2).encode('utf8')
+                etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                self.cache[path] = (version, body, etag)
+            return self.cache[path][1:]
+        
+class tcp_status_server(status_server_mixin, ThreadingHTTPServer):
+    daemon_threads = True
+    
+class unix_status_server(status_server_mixin, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    
+    def server_close(self):
+        super().server_close()
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+    
+#Prometheus metric name: (help, smart value name)
+DRIVE_METRICS = {'drive_info_temperature_celsius' : ('drive temperature', 'temp'),
+                 'drive_info_power_on_hours'      : ('power on hours', 'power_on_hrs'),
+                 'drive_info_written_bytes'       : ('bytes written', 'bytes_written'),
+                 'drive_info_life_percent'        : ('SSD remaining life', 'life'),
+                 'drive_info_spare_percent'       : ('SSD available spare', 'spare')}
+                 
+def metric_labels(labels):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for name, value in labels.items())
+                    
+def get_metrics(drive_data, drives, snapshot=None, updated=None):
+    '''
+    returns the drive data (a dict of disk_info), and RAID status from the raid_config in the Prometheus text format
+    every physical drive has drive, member (physical drive number for RAID volumes), slot, bay and serial labels
+    the RAID status text (eg 'Rebuilding') isn't a label, as it would make a new series each time it changes
+    '''
+    metrics = {name: [] for name in list(DRIVE_METRICS.keys()) + ['drive_info_smart_ok']}
+    for name, drive in drive_data.items():
+        config = drives.get(name, {})
+        members = config['logical_volumes'][0]['drives'] if config.get('logical_volumes') else []
+        for values in drive.as_dict()['drives']:
+            member = values['drive_no']
+            info = members[member] if member is not None and member < len(members) else config
+            labels = metric_labels({'drive'  : name,
+                                    'member' : '' if member is None else member,
+                                    'slot'   : config.get('controller_physid', ''),
+                                    'bay'    : info.get('bay') or '',
+                                    'serial' : info.get('serial') or ''})
+            for metric, (help, value) in DRIVE_METRICS.items():
+                if values['raw'].get(value) is not None:
+                    metrics[metric].append('%s{%s} %s' % (metric, labels, values['raw'][value]))
+            if values['smart_status'] not in [None, SMART_TIMEOUT]:
+                metrics['drive_info_smart_ok'].append('drive_info_smart_ok{%s} %d' % (labels, values['smart_status'] == 'OK'))
+                
+    metrics['drive_info_raid_logical_drive_ok'] = []
+    metrics['drive_info_raid_physical_drive_ok'] = []
+    for controller in (snapshot.controllers if snapshot else []):
+        for array in controller['arrays']:
+            for ld in array['logical_drives']:
+                labels = metric_labels({'slot'         : controller['slot'],
+                                        'logicaldrive' : ld['logicaldrive'],
+                                        'disk'         : ld.get('Disk Name') or ''})
+                metrics['drive_info_raid_logical_drive_ok'].append('drive_info_raid_logical_drive_ok{%s} %d' % (labels, ld.get('Status') == 'OK'))
+        for pd in [pd for array in controller['arrays'] for pd in array['physical_drives']] + controller['unassigned']:
+            labels = metric_labels({'slot'          : controller['slot'],
+                                    'physicaldrive' : pd['physicaldrive'],
+                                    'bay'           : pd.get('Bay', ''),
+                                    'serial'        : pd.get('Serial Number', '')})
+            metrics['drive_info_raid_physical_drive_ok'].append('drive_info_raid_physical_drive_ok{%s} %d' % (labels, pd.get('Status') == 'OK'))
+            
+    metrics['drive_info_last_update_timestamp_seconds'] = ['drive_info_last_update_timestamp_seconds{%s} %s' % (metric_labels({'job': job}), ts)
+                                                           for job, ts in sorted((updated or {}).items())]
+    helps = {name: help for name, (help, value) in DRIVE_METRICS.items()}
+    helps.update({'drive_info_smart_ok'                      : 'SMART health status is OK',
+                  'drive_info_raid_logical_drive_ok'         : 'RAID logical drive status is OK',
+                  'drive_info_raid_physical_drive_ok'        : 'RAID physical drive status is OK',
+                  'drive_info_last_update_timestamp_seconds' : 'time each daemon job last ran'})
+    text = ''
+    for metric, lines in metrics.items():
+        text += '# HELP %s %s\n# TYPE %s gauge\n' % (metric, helps[metric], metric)
+        text += ''.join(line + '\n' for line in lines)
+    return text
+    
+def parse_api_address(address):
+    '''
+    returns ('unix', path) or ('tcp', (host, port)) from 'unix:/path', '/path', 'http://host:port' or 'host:port'
+    '''
+    if address.startswith('unix:'):
+        return 'unix', address[5:]
+    if address.startswith('/'):
+        return 'unix', address
+    address = address.replace('http://', '').rstrip('/')
+    host, _, port = address.rpartition(':')
+    return 'tcp', (host or 'localhost', int(port))
+    
+def start_status_server(address, daemon):
+    '''
+    serve the daemon's drive data on address (see parse_api_address) in a background thread
+    '''
+    kind, address = parse_api_address(address)
+    if kind == 'unix':
+        if os.path.exists(address):
+            os.remove(address)
+        server = unix_status_server(address, status_request_handler)
+    else:
+        server = tcp_status_server(address, status_request_handler)
+    server.setup_cache(daemon)
+    threading.Thread(target=server.serve_forever, name='api', daemon=True).start()
+    log.info('serving drive status on %s' % (address,))
+    return server
+    
+class unix_http_connection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=10):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+        
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+        
+def api_connection(address, timeout=10):
+    kind, address = parse_api_address(address)
+    if kind == 'unix':
+        return unix_http_connection(address, timeout)
+    return http.client.HTTPConnection(address[0], address[1], timeout=timeout)
+    
+def fetch_status(address, path='/status', etag=None, connection=None, timeout=10):
+    '''
+    get the drive status from the daemon's query API at address
+    returns (data, etag), data is None if etag was given and nothing has changed
+    '''
+    conn = connection or api_connection(address, timeout)
+    try:
+        headers = {'If-None-Match': etag} if etag else {}
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        if response.status == 304:
+            return None, etag
+        if response.status != 200:
+            raise http.client.HTTPException('%s %s' % (response.status, response.reason))
+        return json.loads(body.decode('utf8')), response.getheader('ETag')
+    finally:
+        if connection is None:
+            conn.close()
+            
+def read_inventory(inventory_file):
+    '''
+    returns a list of (host name, source) from an inventory file, one host per line, 'name source' or just 'source'
+    source is a daemon query API address (unix:/path or http://host:port) or the path of a summary file (eg on a shared mount)
+    blank lines and lines starting with # are ignored
+    '''
+    hosts = []
+    with open(inventory_file, 'r') as f:
+        for line in f:
+            words = line.split('#', 1)[0].split()
+            if words:
+                hosts.append((words[0], words[-1]))
+    return hosts
+    
+class fleet_aggregator():
+    '''
+    collects the latest drive status from many hosts in parallel, and merges it into one fleet view
+    no more than workers hosts are read at the same time, and a host that hasn't answered within timeout is reported
+    as TIMEOUT, so one unreachable host (or hung NFS mount) can't hold up the rest
+    the workers are daemon threads (not a ThreadPoolExecutor, which is joined at exit) so a hung read can't stop the program exiting
+    HTTP connections and ETags are kept between collect() calls, so polling the fleet again reuses them
+    '''
+    def __init__(self, hosts, max_age=300, workers=16, timeout=10):
+        self.hosts = hosts
+        self.max_age = max_age
+        self.workers = max(workers, 1)
+        self.timeout = timeout
+        self.connections = {}   #source: open connection
+        self.cache = {}         #source: (etag, data)
+        self.connections_lock = threading.Lock()
+        
+    def fetch_api(self, source):
+        with self.connections_lock:
+            connection = self.connections.pop(source, None) or api_connection(source, self.timeout)
+            etag, data = self.cache.get(source, (None, None))
+        try:
+            new_data, etag = fetch_status(source, '/status', etag, connection)
+        except Exception:
+            connection.close()
+            raise
+        with self.connections_lock:
+            self.connections[source] = connection
+            if new_data is not None:
+                data = new_data
+                self.cache[source] = (etag, data)
+        return data['timestamp'], data['status'], data['summary'].strip()
+        
+    def fetch(self, name, source):
+        '''
+        returns the fleet view entry for one host
+        '''
+        entry = {'host': name, 'source': source, 'status': 'UNREACHABLE', 'timestamp': None, 'age': None, 'summary': '', 'error': None}
+        try:
+            if is_api_address(source):
+                timestamp, ok, summary = self.fetch_api(source)
+            else:
+                data = read_summary_file(source)
+                timestamp, ok, summary = data['timestamp'], data['status'], data['summary'].strip()
+        except (OSError, ValueError, KeyError, http.client.HTTPException) as e:
+            entry['error'] = str(e) or e.__class__.__name__
+            return entry
+        entry['summary'] = summary
+        entry['timestamp'] = timestamp
+        entry['age'] = time.time() - timestamp if timestamp is not None else None
+        if entry['age'] is None or entry['age'] > self.max_age:
+            entry['status'] = 'STALE'
+        else:
+            entry['status'] = 'OK' if ok else 'FAILED'
+        return entry
+        
+    def collect(self):
+        '''
+        returns a list of the fleet view entries for all the hosts, in inventory order
+        '''
+        pending = queue.Queue()
+        for index, host in enumerate(self.hosts):
+            pending.put((index, host))
+        results = {}
+        finished = threading.Condition()
+        
+        def worker():
+            while True:
+                try:
+                    index, (name, source) = pending.get_nowait()
+                except queue.Empty:
+                    return
+                entry = self.fetch(name, source)
+                with finished:
+                    results[index] = entry
+                    finished.notify()
+                    
+        for count in range(min(self.workers, len(self.hosts))):
+            threading.Thread(target=worker, name='aggregate-%d' % count, daemon=True).start()
+        #each batch of workers hosts gets timeout seconds
+        deadline = time.time() + self.timeout * -(-len(self.hosts) // self.workers) + 1
+        with finished:
+            finished.wait_for(lambda: len(results) == len(self.hosts), max(deadline - time.time(), 0))
+            fleet = []
+            for index, (name, source) in enumerate(self.hosts):
+                fleet.append(results.get(index) or {'host': name, 'source': source, 'status': 'TIMEOUT', 'timestamp': None, 'age': None,
+                                                    'summary': '', 'error': 'no answer in %ss' % self.timeout})
+        return fleet
+        
+    def close(self):
+        with self.connections_lock:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections = {}
+            
+def print_fleet(fleet):
+    for entry in fleet:
+        age = '%ds' % entry['age'] if entry['age'] is not None else '-'
+        detail = entry['error'] or entry['summary'].replace('\n', '; ')
+        print('%-20s %-11s %8s  %s' % (entry['host'], entry['status'], age, detail))
+        
+def is_api_address(address):
+    return address.startswith('unix:') or address.startswith('http://')
+        
 def setup_logger(logger_name, log_file, level=logging.DEBUG, console=False):
     try:
         l = logging.getLogger(logger_name)
@@ -506,15 +3367,59 @@ def setup_logger(logger_name, log_file, level=logging.DEBUG, console=False):
             print("Log Error: %s" % e)
         sys.exit(1)
         
+def report_timings(arg):
+    '''
+    log the timing report as JSON in debug mode, and the profile if --profile was given
+    '''
+    if arg.debug:
+        log.debug('timing report: %s' % json.dumps(timer.report(get_runner().stats), sort_keys=True))
+    if arg.profile:
+        log.info('saved profile to %s, top functions:\n%s' % (arg.profile, timer.profile_stats(arg.profile)))
+        
 def main():
     import argparse
     #-------- Command Line -----------------
     parser = argparse.ArgumentParser(description='Check Drive Stats')
     parser.add_argument('-l','--log', action='store',type=str, default="/home/nick/Scripts/drive_info.log", help='path/name of log file (default: /home/nick/Scripts/drive_info.log)')
     parser.add_argument('-ws','--writesummaryfile', action='store',type=str, default="/home/nick/Scripts/disk_info.txt", help='path/name of write summary file (default: /home/nick/Scripts/disk_info.txt)')
-    parser.add_argument('-rs','--readsummaryfile', action='store',type=str, default="/shares/nick/Scripts/disk_info.txt", help='path/name of read summary file (default: /shares/nick/Scripts/disk_info.txt)')
+    parser.add_argument('-rs','--readsummaryfile', action='store',type=str, default="/shares/nick/Scripts/disk_info.txt", help='path/name of read summary file, or daemon query API address (unix:/path or http://host:port) (default: /shares/nick/Scripts/disk_info.txt)')
+    parser.add_argument('-ma','--maxage', action='store',type=int, default=300, help='max age in seconds of summary data read in a VM (default: 300)')
     parser.add_argument('-r','--rescan', action='store_true', help='rescan drives', default = False)
+    parser.add_argument('-i','--incremental', action='store_true', help='rescan only drives that have been added or changed', default = False)
     parser.add_argument('-S','--summary', action='store_true', help='summary', default = False)
+    parser.add_argument('-w','--workers', action='store',type=int, default=1, help='number of drives to query in parallel (default: 1)')
+    parser.add_argument('-cw','--controllerworkers', action='store',type=int, default=2, help='max number of drives to query in parallel on one RAID controller (default: 2)')
+    parser.add_argument('-J','--json', action='store_true', help='use smartctl JSON output if smartctl supports it (7.0 or later)', default = False)
+    parser.add_argument('-t','--timeout', action='store',type=float, default=None, help='timeout in seconds for each external command (default: depends on the command)')
+    parser.add_argument('-b','--budget', action='store',type=float, default=None, help='most seconds the whole run can take (not in daemon mode), commands still running then are killed, and drives not read in time are reported as %s (default: no limit)' % SMART_TIMEOUT)
+    parser.add_argument('-dt','--devicetimeout', action='store',type=float, default=None, help='timeout in seconds for reading the SMART data of each drive (default: the smartctl timeout)')
+    parser.add_argument('-d','--daemon', action='store_true', help='run continuously, polling the drives on a schedule', default = False)
+    parser.add_argument('-pi','--pollinterval', action='store',type=int, default=900, help='daemon: seconds between reading all SMART data (default: 900)')
+    parser.add_argument('-hi','--healthinterval', action='store',type=int, default=60, help='daemon: seconds between SMART health checks (default: 60)')
+    parser.add_argument('-ad','--adaptive', action='store_true', help='daemon: read healthy, stable drives less often (up to --maxinterval), and drives with problems every --healthinterval, with a health check in between', default = False)
+    parser.add_argument('-hp','--hotplug', action='store_true', help='daemon: watch for drives being added, removed or changed (kernel uevents), and update and read just those drives straight away', default = False)
+    parser.add_argument('-mi','--maxinterval', action='store',type=int, default=3600, help='daemon: with --adaptive, max seconds between reading all SMART data of a healthy drive (default: 3600)')
+    parser.add_argument('-ri','--raidinterval', action='store',type=int, default=60, help='daemon: seconds between RAID status checks (default: 60)')
+    parser.add_argument('-st','--selftest', action='store',type=str, default='00:00', help='daemon: time (HH:MM) to run a short self test each day, "" to disable (default: 00:00)')
+    parser.add_argument('-a','--api', action='store',type=str, default=None, help='daemon: serve drive status as JSON on this address, unix:/path or host:port (default: None)')
+    parser.add_argument('-hs','--history', action='store',type=str, default=None, help='path/name of SQLite database to keep a history of the SMART values in (default: None)')
+    parser.add_argument('-sh','--showhistory', action='store',type=str, nargs='*', default=None, help='show the history of these drives (all drives if none given) and exit')
+    parser.add_argument('-wt','--wearthreshold', action='store',type=float, default=10, help='remaining SSD life %% to project wear to, needs --history (default: 10)')
+    parser.add_argument('-wh','--wearhorizon', action='store',type=float, default=90, help='warn if a drive is projected to reach --wearthreshold within this many days (default: 90)')
+    parser.add_argument('-hd','--historydays', action='store',type=float, default=7, help='days of history to show (default: 7)')
+    parser.add_argument('-dc','--drivedbcache', action='store',type=str, default=None, help='directory to keep the smartctl drive database (drivedb.h) in (default: /var/cache/drive_info, or ~/.cache/drive_info if not root)')
+    parser.add_argument('-dm','--drivedbmaxage', action='store',type=float, default=7, help='days between checking for a new drive database, 0 to never download it (default: 7)')
+    parser.add_argument('-di','--discovery', action='store',type=str, choices=['sysfs', 'lshw'], default='sysfs', help='find the drives from sysfs, or with lsblk and lshw (default: sysfs, lshw with --record or --replay)')
+    parser.add_argument('-ns','--nvmesmartctl', action='store_true', help='read NVMe drives with smartctl, rather than the NVMe admin ioctl', default = False)
+    parser.add_argument('-rb','--raidbackend', action='append',type=str, choices=[backend.name for backend in RAID_BACKENDS], default=None, help='RAID backend to use, can be given more than once (default: all of them, ssacli for HP Smart Array, storcli for MegaRAID/PERC, mdstat for Linux software RAID)')
+    parser.add_argument('-ag','--aggregate', action='store',type=str, default=None, help='show the drive status of all the hosts in this inventory file (one "name source" per line, source is a summary file or query API address), and exit')
+    parser.add_argument('-aw','--aggregateworkers', action='store',type=int, default=16, help='--aggregate: number of hosts to query in parallel (default: 16)')
+    parser.add_argument('-aj','--aggregatejson', action='store_true', help='--aggregate: print the fleet status as JSON', default = False)
+    parser.add_argument('-cc','--commandcache', action='store',type=str, nargs='?', const='', default=None, help='reuse smartctl and RAID controller output from this or other runs, if it is recent enough (1 minute for health and RAID status, 10 for SMART data, 60 for drive identity), cached in this directory (default: /var/cache/drive_info/commands, or ~/.cache/drive_info/commands if not root)')
+    parser.add_argument('--record', action='store',type=str, default=None, help='save the output of every external command in this directory, for --replay (default: None)')
+    parser.add_argument('--replay', action='store',type=str, default=None, help='use the command output saved by --record in this directory, instead of running the commands (default: None)')
+    parser.add_argument('--replaylatency', action='store',type=float, default=0, help='--replay: multiply the recorded time each command took by this, and wait that long (default: 0)')
+    parser.add_argument('-p','--profile', action='store',type=str, default=None, help='save a cProfile of the drive scanning and parsing to this file, and log the top functions (default: None)')
     parser.add_argument('-D','--debug', action='store_true', help='debug mode', default = False)
     parser.add_argument('--version', action='version', version="%(prog)s ("+__version__+")")
 
@@ -522,6 +3427,13 @@ def main():
 
     #----------- Global Variables -----------
     global log
+    global runner
+    global nvme_ioctl
+    global discovery
+    global raid_backends
+    global device_timeout
+    global timer
+    global drivedb
     #-------------- Main --------------
 
     if arg.debug:
@@ -546,60 +3458,151 @@ def main():
     
     log.debug("DEBUG mode on")
     
+    if arg.profile:
+        #cProfile only follows the thread it's started in, so do everything in this thread
+        log.info('profiling, using 1 worker')
+        arg.workers = 1
+        timer = stage_timer(cProfile.Profile())
+        
+    if arg.replay:
+        log.info('replaying commands from %s' % arg.replay)
+        runner = replay_runner(arg.replay, arg.replaylatency, max_running=max(8, arg.workers), timeout=arg.timeout)
+    else:
+        cache = command_cache(arg.commandcache or None) if arg.commandcache is not None else None
+        runner = command_runner(max_running=max(8, arg.workers), timeout=arg.timeout, record=arg.record, cache=cache)
+    if arg.budget and not arg.daemon:
+        runner.deadline = time.time() + arg.budget
+    nvme_ioctl = not arg.nvmesmartctl
+    raid_backends = arg.raidbackend
+    device_timeout = arg.devicetimeout
+    #replayed runs have the recorded lsblk and lshw output, not the host's sysfs, so recorded runs use lsblk and lshw too
+    discovery = 'lshw' if arg.replay or arg.record else arg.discovery
+    
+    if arg.aggregate:
+        aggregator = fleet_aggregator(read_inventory(arg.aggregate), arg.maxage, arg.aggregateworkers, arg.timeout or 10)
+        fleet = aggregator.collect()
+        aggregator.close()
+        if arg.aggregatejson:
+            print(json.dumps({'timestamp': time.time(), 'hosts': fleet}, indent=2))
+        else:
+            print_fleet(fleet)
+        sys.exit(0 if all(entry['status'] == 'OK' for entry in fleet) else 1)
+        
     if is_virtual():
-        #running in VM or container - don't read actual disks or anything, look for file written by actual host
-        if os.path.isfile(arg.readsummaryfile):
-            with open(arg.readsummaryfile, 'r') as f:
-                disk_data = f.read()
-                disk_time = disk_data.split(' ').pop(0)
-                if time.time() -300 <= float(disk_time):
-                    print(disk_data.replace(disk_time, '').strip())
+        #running in VM or container - don't read actual disks or anything, ask the host's daemon, or look for file written by actual host
+        if is_api_address(arg.readsummaryfile):
+            try:
+                data, etag = fetch_status(arg.readsummaryfile)
+                if data['timestamp'] is not None and time.time() - arg.maxage <= data['timestamp']:
+                    print(data['summary'].strip())
                     sys.exit(0)
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                log.warning('could not get drive status from %s: %s' % (arg.readsummaryfile, e))
+        elif os.path.isfile(arg.readsummaryfile):
+            try:
+                data = read_summary_file(arg.readsummaryfile, arg.maxage)
+                if data is not None:
+                    print(data['summary'].strip())
+                    sys.exit(0)
+            except (OSError, ValueError, KeyError) as e:
+                log.warning('could not read drive status from %s: %s' % (arg.readsummaryfile, e))
         print('No disk_info available')
         sys.exit(1)
     
     config_file = "config.ini"
     
-    if not os.path.isfile('drivedb.h'):
-        log.info('getting latest drive database')
-        check_output('wget --content-disposition https://sourceforge.net/p/smartmontools/code/HEAD/tree/trunk/smartmontools/drivedb.h?format=raw'.split())
+    if arg.showhistory is not None:
+        if not arg.history:
+            log.error('no history database given (-hs)')
+            sys.exit(1)
+        history = history_store(arg.history)
+        print_history(history, arg.showhistory, arg.historydays)
+        history.close()
+        sys.exit(0)
     
-    if os.path.isfile(config_file) and not arg.rescan:
-        drives = load_drives(config_file)
-    else:
-        drives = get_drives(config_file)
+    drivedb = drive_database(arg.drivedbcache, arg.drivedbmaxage)
+    if not arg.replay and arg.drivedbmaxage > 0:
+        drivedb.refresh_in_background()
+    
+    start = time.time()
+    discovery_issues = ''
+    try:
+        if arg.incremental and not arg.rescan:
+            with timer.stage('rescan_drives'):
+                drives = rescan_drives(config_file)
+        elif os.path.isfile(config_file) and not arg.rescan:
+            with timer.stage('load_drives'):
+                drives = load_drives(config_file)
+        else:
+            with timer.stage('get_drives'):
+                drives = get_drives(config_file)
+    except TimeoutExpired as e:
+        #nothing to fall back on, so the drives aren't known, but the summary is still written in time
+        log.warning('could not find the drives: %s' % e)
+        drives = {}
+        discovery_issues = 'drives (finding the drives %s)\n' % SMART_TIMEOUT
         
     log.debug('got drive info: \n%s' % json.dumps(drives, indent=2))
     
-    data = get_smart_data(drives)
+    use_json = False
+    if arg.json:
+        use_json = smartctl_supports_json()
+        if not use_json:
+            log.info('smartctl version does not support JSON output, using text')
+    
+    if arg.commandcache is not None and not arg.replay:
+        #cached output of the physical drives behind RAID controllers is keyed by their serial numbers (see raid_member_serial),
+        #so read the RAID configuration first, it's the same one check_raid_failures uses
+        with timer.stage('get_raid_snapshot'):
+            get_raid_snapshot()
+            
+    if arg.daemon:
+        drive_daemon(arg, drives, config_file, use_json).run()
+        report_timings(arg)
+        runner.stop()
+        sys.exit(0)
+    
+    with timer.stage('get_smart_data'):
+        data = get_smart_data(drives, arg.workers, arg.controllerworkers, use_json)
     summary=""
     status = True
-    if not arg.summary:
-        print_smart_data(data)
-    else:
-        summary, status = get_smart_data_summary(data)
-    raid_issues = check_raid_failures(arg)
-    if raid_issues != "":
-        if not status:
-            summary += raid_issues
+    with timer.stage('smart_data_summary'):
+        if not arg.summary:
+            print_smart_data(data)
         else:
-            summary = raid_issues
-        status = False
+            summary, status = get_smart_data_summary(data)
+    with timer.stage('check_raid_failures'):
+        raid_issues = check_raid_failures(arg)
+    summary, status = combine_summary(summary, status, discovery_issues + raid_issues)
     
-    try:
-        if summary == '':
-            summary = 'no data'
-        with open(arg.writesummaryfile, 'w') as f:
-            text = '%s %s' % (time.time(), summary)
-            f.write(text)
-    except Exception as e:
-        log.warning('Error writing summary file: %s' % e)
+    wear_warnings = ''
+    if arg.history:
+        with timer.stage('history'):
+            history = history_store(arg.history)
+            history.append(data)
+            wear_warnings = get_wear_warnings(history, arg.wearthreshold, arg.wearhorizon)
+            history.close()
+        if not arg.summary and wear_warnings != '':
+            log.info('Wear Warnings: %s' % wear_warnings)
+        summary, status = combine_summary(summary, status, wear_warnings)
+    
+    with timer.stage('write_summary_file'):
+        write_summary_file(arg.writesummaryfile, get_summary_data(data, summary, status, raid_issues, wear_warnings, time.time() - start))
+    
+    report_timings(arg)
     
     if arg.summary:
+        #the summary and exit code aren't held up by a drive database download, it's tried again later if it's cut off
         print(summary)
         
         if 'failed' in summary.lower() or not status:
-            sys.exit(1)
+            #a distinct exit code if the only problem is drives or RAID controllers that didn't answer in time
+            timeouts = all(SMART_TIMEOUT in line for line in summary.strip().split('\n'))
+            sys.exit(EXIT_TIMEOUT if timeouts else 1)
+    else:
+        #the drives have all been read, give a drive database download a chance to finish, so it's there next time
+        remaining = runner.remaining()
+        drivedb.wait(drivedb.timeout if remaining is None else min(drivedb.timeout, remaining))
 
 if __name__ == "__main__":
     main()